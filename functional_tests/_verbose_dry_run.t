@@ -69,6 +69,7 @@ it for real.::
 
   $ git blackhole push -vn | sed s/$(hostname)/myhost/g
   git push --force blackhole master HEAD:refs/heads/heads/myhost/local/HEAD
+  Estimated push: * objects, * (glob)
 
 
 ``git blackhole trash-branch --verbose --dry-run``
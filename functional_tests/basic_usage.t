@@ -234,7 +234,7 @@ notify you that any upstream branch is not touched::
   To ../blackhole.git
    * [new branch]      * -> trash/*/local/*/* (glob)
   Deleted branch garbage (was *). (glob)
-  Not removing upstream branch as upstream is not configured.
+  Not removing upstream branch of garbage as upstream is not configured.
 
 
 Trash stash
@@ -32,7 +32,9 @@ There are three main features of ``git-blackhole``:
 
    For example, if you forget to push a commit from your desktop (to
    the usual remote) but want to resume the work from your laptop,
-   ``git blackhole warp`` would be helpful.
+   ``git blackhole warp`` would be helpful.  With ``git blackhole
+   warp --prefetch``, the other repository is fetched in background
+   after each push so that switching machines does not wait for it.
 
 3. **Recoverable trash can**.  Use ``git blackhole trash-branch`` and
    ``git blackhole trash-stashes`` to remove branches and stashes from
@@ -40,6 +42,10 @@ There are three main features of ``git-blackhole``:
    repository.  They are stored remotely as ordinary branches so that
    you can recover them easily.
 
+When the blackhole repository is accessed over SSH, git commands run
+by a single ``git blackhole`` command share one connection per host.
+Set config ``blackhole.sshMultiplex`` to false to disable it.
+
 .. _git-wip: https://github.com/bartman/git-wip
 
 """
@@ -48,7 +54,7 @@ from __future__ import print_function
 
 import os
 import sys
-from subprocess import check_output, CalledProcessError
+from subprocess import CalledProcessError
 
 __version__ = '0.1.1.dev1'
 __author__ = 'Takafumi Arakaki'
@@ -59,11 +65,99 @@ class BlackholeError(RuntimeError):
     pass
 
 
+class UnsupportedRepository(BlackholeError):
+    """
+    Raised when `ObjectReader` cannot read the repository.
+    """
+
+
+class BlackholeTimeout(BlackholeError):
+    """
+    Raised when a command does not finish before the deadline.
+    """
+
+
+class NotConfigured(BlackholeError):
+    """
+    Raised when the blackhole remote is not configured.
+    """
+
+
+class GitCommandError(BlackholeError):
+    """
+    Raised by `Blackhole` when a git command fails.
+
+    Attributes `returncode`, `cmd` and `output` are taken from
+    `subprocess.CalledProcessError`.
+    """
+
+    def __init__(self, err):
+        super(GitCommandError, self).__init__(str(err))
+        self.returncode = err.returncode
+        self.cmd = err.cmd
+        self.output = err.output
+
+
+_deadline = None
+
+
+def set_deadline(timeout=None, deadline=None):
+    """
+    Kill commands still running `timeout` seconds after now.
+
+    Commands started by `make_run`, `check_output` and
+    `check_communicate` are run in their own process group, which is
+    killed at the deadline.  The deadline can also be given as a UNIX
+    time `deadline`.  The deadline is removed if neither is given.
+    Return the previous deadline.
+
+    """
+    import time
+    global _deadline
+    previous = _deadline
+    if timeout is not None:
+        deadline = time.time() + timeout
+    _deadline = deadline
+    return previous
+
+
+def popen(cmd, **kwds):
+    from subprocess import Popen
+    if _deadline is not None:
+        kwds['start_new_session'] = True
+    return Popen(cmd, **kwds)
+
+
+def communicate(proc, cmd, input=None):
+    """
+    Run ``proc.communicate(input)`` until the deadline.
+    """
+    import signal
+    import time
+    from subprocess import TimeoutExpired
+    if _deadline is None:
+        return proc.communicate(input)
+    try:
+        return proc.communicate(input,
+                                timeout=max(_deadline - time.time(), 0))
+    except BaseException as err:
+        # The process group does not receive signals (e.g., SIGINT by
+        # Ctrl-C) sent to our group; kill it so that nothing is left.
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        proc.wait()
+        if isinstance(err, TimeoutExpired):
+            raise BlackholeTimeout('Timed out: {0}'.format(' '.join(cmd)))
+        raise
+
+
 def make_run(verbose, dry_run, check=True):
-    from subprocess import check_call, call
 
     def run(*command, **kwds):
         out = kwds.pop('out', False)
+        input = kwds.pop('input', None)
         if verbose:
             redirects = ()
             if 'stdout' in kwds:
@@ -73,7 +167,15 @@ def make_run(verbose, dry_run, check=True):
         if out:
             return check_output(command, **kwds)
         elif not dry_run:
-            return (check_call if check else call)(command, **kwds)
+            if input is not None:
+                kwds.setdefault('stdout', None)
+                kwds.setdefault('stderr', None)
+                return check_communicate(command, input, **kwds)
+            proc = popen(command, **kwds)
+            communicate(proc, command)
+            if check and proc.returncode != 0:
+                raise CalledProcessError(proc.returncode, command)
+            return proc.returncode
     return run
 
 
@@ -116,14 +218,23 @@ def getbranches():
     return branches, checkedout_branches
 
 
-def getrefs():
-    out = check_output(['git', 'show-ref']).decode()
-    for line in out.splitlines():
-        yield line.rstrip().split(None, 1)
+def getrefnames(patterns=None):
+    """
+    List refs matching `patterns` (as understood by git-for-each-ref).
 
+    All refs are listed when `patterns` is not given.
+    """
+    out = check_output(['git', 'for-each-ref', '--format=%(refname)', '--'] +
+                       list(patterns or ()))
+    return out.decode().splitlines()
 
-def getrefnames():
-    return [ref for (_sha1, ref) in getrefs()]
+
+def ls_remote(run, remote, *patterns):
+    """
+    Return a list of ``(sha1, ref)`` in `remote` matching `patterns`.
+    """
+    out = run('git', 'ls-remote', remote, *patterns, out=True)
+    return [tuple(l.split(None, 1)) for l in out.decode().splitlines()]
 
 
 def getconfig(name, aslist=False):
@@ -139,6 +250,44 @@ def getconfig(name, aslist=False):
     return out.split('\0')[:-1] if aslist else out.rstrip('\0')
 
 
+def getgitpath(path):
+    """
+    Return the path to `path` in ``$GIT_DIR``.
+
+    See: ``git rev-parse --git-path``
+    """
+    out = check_output(['git', 'rev-parse', '--git-path', path])
+    return out.decode().rstrip('\n')
+
+
+def load_json(path, default=None):
+    import json
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except (IOError, OSError, ValueError):
+        return default
+
+
+def dump_json(path, obj):
+    """
+    Write `obj` to `path` atomically.
+    """
+    import json
+    import tempfile
+    dirpath = os.path.dirname(path)
+    if dirpath and not os.path.isdir(dirpath):
+        os.makedirs(dirpath)
+    (fd, tmppath) = tempfile.mkstemp(dir=dirpath or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as file:
+            json.dump(obj, file, indent=1, sort_keys=True)
+        os.replace(tmppath, path)
+    except BaseException:
+        os.remove(tmppath)
+        raise
+
+
 def check_communicate(cmd, input, **kwds):
     """
     Run ``Popen(cmd, **kwds).communicate(input)`` and bark on an error.
@@ -147,19 +296,33 @@ def check_communicate(cmd, input, **kwds):
     True
 
     """
-    from subprocess import Popen, PIPE
+    from subprocess import PIPE
     if 'stderr' not in kwds:
         kwds['stderr'] = PIPE
-    proc = Popen(cmd, stdin=PIPE, stdout=PIPE, **kwds)
+    kwds.setdefault('stdout', PIPE)
+    kwds.setdefault('stdin', PIPE)
+    proc = popen(cmd, **kwds)
     if input is not None and not isinstance(input, bytes):
         input = input.encode()
-    (stdout, stderr) = proc.communicate(input)
+    (stdout, stderr) = communicate(proc, cmd, input)
     if proc.returncode != 0:
         output = stdout if stderr is None else stderr
         raise CalledProcessError(proc.returncode, cmd, output)
     return stdout
 
 
+def check_output(cmd, **kwds):
+    """
+    Like `subprocess.check_output` but respect the deadline.
+
+    >>> check_output(['echo', 'hey']) == b'hey\\n'
+    True
+
+    """
+    kwds.setdefault('stderr', None)
+    return check_communicate(cmd, None, stdin=None, **kwds)
+
+
 def git_annot_commit(message, parent):
     """
     Make a commit with `message` on top of `parent` commit.
@@ -183,12 +346,80 @@ def git_annot_commit(message, parent):
     return rev.decode().rstrip('\n')
 
 
-def git_json_commit(heading, obj, parent):
+def git_idents():
+    return [check_output(['git', 'var', v]).decode().rstrip('\n')
+            for v in ['GIT_AUTHOR_IDENT', 'GIT_COMMITTER_IDENT']]
+
+
+def format_commit(tree, parents, message, idents):
+    return 'tree {0}\n{1}author {2}\ncommitter {3}\n\n{4}'.format(
+        tree, ''.join('parent {0}\n'.format(p) for p in parents),
+        idents[0], idents[1], message)
+
+
+def git_mkcommit(tree, parents, message):
+    """
+    Make a commit of `tree` with arbitrary number of `parents`.
+
+    Unlike ``git commit-tree``, the parents are not passed via the
+    command line so that there is no limit on the number of them.
+
+    """
+    content = format_commit(tree, parents, message, git_idents())
+    rev = check_communicate(
+        ['git', 'hash-object', '-t', 'commit', '-w', '--stdin'], content)
+    return rev.decode().rstrip('\n')
+
+
+def git_annot_commits(annotations):
+    """
+    Make annotation commits for a list of ``(message, parent)`` pairs.
+
+    This makes the same commits as `git_annot_commit` but the number
+    of git processes does not depend on the number of `annotations`:
+    parents and trees are resolved by one ``git cat-file`` and the
+    commits are written by one ``git hash-object``.
+
+    """
+    import shutil
+    import tempfile
+    if not annotations:
+        return []
+    query = ''.join('{0}^{{commit}}\n{0}^{{tree}}\n'.format(parent)
+                    for (_, parent) in annotations)
+    out = check_communicate(
+        ['git', 'cat-file', '--batch-check=%(objectname)'], query)
+    resolved = out.decode().splitlines()
+    for ((_, parent), sha1) in zip(annotations, resolved[::2]):
+        if ' ' in sha1:
+            raise BlackholeError('Not a valid commit: {0}'.format(parent))
+    idents = git_idents()
+    tmpdir = tempfile.mkdtemp(prefix='git-blackhole-')
+    try:
+        paths = []
+        for (i, (message, _)) in enumerate(annotations):
+            path = os.path.join(tmpdir, str(i))
+            with open(path, 'wb') as file:
+                file.write(format_commit(
+                    resolved[2 * i + 1], [resolved[2 * i]], message,
+                    idents).encode())
+            paths.append(path)
+        out = check_communicate(
+            ['git', 'hash-object', '-t', 'commit', '-w', '--stdin-paths'],
+            ''.join(p + '\n' for p in paths))
+    finally:
+        shutil.rmtree(tmpdir)
+    return out.decode().split()
+
+
+def format_json_message(heading, obj):
     import json
-    return git_annot_commit(
-        "GIT-BLACKHOLE: {}\n\nGIT-BLACKHOLE-JSON:\n{}"
-        .format(heading, json.dumps(obj)),
-        parent)
+    return "GIT-BLACKHOLE: {}\n\nGIT-BLACKHOLE-JSON:\n{}".format(
+        heading, json.dumps(obj))
+
+
+def git_json_commit(heading, obj, parent):
+    return git_annot_commit(format_json_message(heading, obj), parent)
 
 
 def parse_json_message(message):
@@ -212,14 +443,44 @@ def cmd_push(remote, force=False, verify=None):
     return cmd
 
 
-def trash_commitish(commitish, remote, info, headingtemp,
-                    verbose, dry_run, **kwds):
+def trashrecordpath():
+    return getgitpath('blackhole/trashed.json')
+
+
+def update_trash_record(url, trashes):
     """
-    Push `commitish` to `remote` trash.
+    Record `trashes` as trashed in the blackhole at `url`.
+
+    The record maps the URL to a dict from the trashed commit (`rev`)
+    to a dict from the branch name (empty for stashes) to the trash
+    commit (`rev_info`).
+    """
+    path = trashrecordpath()
+    records = load_json(path, {})
+    record = records.setdefault(url, {})
+    for trash in trashes:
+        record.setdefault(trash['rev'], {})[trash.get('branch', '')] = \
+            trash['rev_info']
+    dump_json(path, records)
+
+
+def trash_commitishes(trashes, remote, verbose, dry_run, **kwds):
+    """
+    Push commits to `remote` trash with one ``git push``.
+
+    `trashes` is a list of ``(commitish, info, headingtemp)``.  Commits
+    already trashed (under the same branch name, if any) are skipped
+    if their trash is confirmed to exist in the remote by ``git
+    ls-remote``; otherwise (e.g., the remote is recreated) they are
+    trashed again.
+
+    Return a list of dicts, one for each of `trashes`, with keys
+    `commitish`, `rev` (the trashed commit), `branch` (empty for
+    stashes), `rev_info` (the trash commit), `ref` (the trash branch in
+    `remote`) and `pushed` (false if it was already trashed).
     """
     run = make_run(verbose, dry_run)
     prefix = getprefix('trash')
-    rev = check_output(['git', 'rev-parse', commitish]).strip()
     url = getconfig('remote.{0}.url'.format(remote))
     if url is None:
         raise BlackholeError(
@@ -227,26 +488,405 @@ def trash_commitish(commitish, remote, info, headingtemp,
             "Please run `git blackhole init` first.\n"
             "(Note: remote.{}.url is not configured.)"
             .format(remote))
-    info = dict(info, **getrecinfo())
-    heading = headingtemp.format(**info)
-    rev = git_json_commit(heading, info, commitish)
-    refspec = '{0}:refs/heads/{1}/{2}/{3}'.format(rev, prefix,
-                                                  rev[:2], rev[2:])
-    run(*cmd_push(url, **kwds) + [refspec])
-    return refspec
+    out = check_communicate(
+        ['git', 'cat-file', '--batch-check=%(objectname)'],
+        ''.join('{0}^{{commit}}\n'.format(c) for (c, _, _) in trashes))
+    sha1s = out.decode().splitlines()
+    for ((commitish, _, _), sha1) in zip(trashes, sha1s):
+        if ' ' in sha1:
+            raise BlackholeError('Not a valid commit: {0}'.format(commitish))
+
+    def trashref(rev_info):
+        return 'refs/heads/{0}/{1}/{2}'.format(prefix, rev_info[:2],
+                                               rev_info[2:])
+
+    record = load_json(trashrecordpath(), {}).get(url, {})
+    recorded = set(
+        trashref(record[sha1][info.get('branch', '')])
+        for ((_, info, _), sha1) in zip(trashes, sha1s)
+        if info.get('branch', '') in record.get(sha1, {}))
+    confirmed = set()
+    if recorded:
+        confirmed = set(ref for (_, ref) in
+                        ls_remote(run, url, *sorted(recorded)))
+
+    recinfo = getrecinfo()
+    annotations = []
+    results = []
+    pushed = []
+    new = {}
+    for ((commitish, info, headingtemp), sha1) in zip(trashes, sha1s):
+        branch = info.get('branch', '')
+        rev_info = record.get(sha1, {}).get(branch)
+        result = dict(commitish=commitish, rev=sha1, branch=branch,
+                      rev_info=rev_info, pushed=False)
+        results.append(result)
+        if (sha1, branch) in new or \
+                (rev_info and trashref(rev_info) in confirmed):
+            continue
+        result['pushed'] = True
+        new[(sha1, branch)] = result
+        pushed.append(result)
+        info = dict(info, **recinfo)
+        heading = headingtemp.format(**info)
+        annotations.append((format_json_message(heading, info), sha1))
+    if pushed:
+        revs = git_annot_commits(annotations)
+        for (result, rev) in zip(pushed, revs):
+            result['rev_info'] = rev
+    for result in results:
+        result['rev_info'] = new.get((result['rev'], result['branch']),
+                                     result)['rev_info']
+        result['ref'] = trashref(result['rev_info'])
+    if pushed:
+        run(*cmd_push(url, **kwds) + [
+            '{0}:{1}'.format(r['rev_info'], r['ref']) for r in pushed])
+        if not dry_run:
+            update_trash_record(url, pushed)
+            update_metrics(recinfo['repo'], dict(trash_total=len(pushed)))
+    return results
+
+
+def trash_commitish(commitish, remote, info, headingtemp,
+                    verbose, dry_run, **kwds):
+    """
+    Push `commitish` to `remote` trash.
+
+    Return the pushed refspec or `None` if `commitish` is already
+    trashed.
+    """
+    [trash] = trash_commitishes([(commitish, info, headingtemp)], remote,
+                                verbose, dry_run, **kwds)
+    if trash['pushed']:
+        return '{0}:{1}'.format(trash['rev_info'], trash['ref'])
 
 
-def trashinfo(rev):
-    out = check_output(['git', 'show', '--format=format:%B', rev])
+def find_git_dirs(path='.'):
+    """
+    Find the git directory and common directory without running git.
+
+    Raise `UnsupportedRepository` if they cannot be determined.
+    """
+    gitdir = os.environ.get('GIT_DIR')
+    if not gitdir:
+        path = os.path.abspath(path)
+        while True:
+            dotgit = os.path.join(path, '.git')
+            if os.path.isdir(dotgit):
+                gitdir = dotgit
+                break
+            elif os.path.isfile(dotgit):
+                with open(dotgit) as file:
+                    line = file.readline().strip()
+                if not line.startswith('gitdir: '):
+                    raise UnsupportedRepository('Unknown .git file')
+                gitdir = os.path.join(path, line[len('gitdir: '):])
+                break
+            elif os.path.isfile(os.path.join(path, 'HEAD')) and \
+                    os.path.isdir(os.path.join(path, 'objects')):
+                gitdir = path  # bare repository
+                break
+            parent = os.path.dirname(path)
+            if parent == path:
+                raise UnsupportedRepository('Not in a git repository')
+            path = parent
+    commondir = os.environ.get('GIT_COMMON_DIR')
+    if not commondir:
+        commondir = gitdir
+        if os.path.isfile(os.path.join(gitdir, 'commondir')):
+            with open(os.path.join(gitdir, 'commondir')) as file:
+                commondir = os.path.join(gitdir, file.read().strip())
+    return (os.path.abspath(gitdir), os.path.abspath(commondir))
+
+
+def apply_delta(base, delta):
+    """
+    Reconstruct an object from `base` and git's binary `delta`.
+    """
+    def varint(pos):
+        (value, shift) = (0, 0)
+        while True:
+            c = delta[pos]
+            pos += 1
+            value |= (c & 0x7f) << shift
+            shift += 7
+            if not c & 0x80:
+                return (value, pos)
+
+    delta = bytearray(delta)
+    (_, pos) = varint(0)
+    (size, pos) = varint(pos)
+    out = bytearray()
+    while pos < len(delta):
+        op = delta[pos]
+        pos += 1
+        if op & 0x80:  # copy from base
+            (offset, length) = (0, 0)
+            for i in range(4):
+                if op & (1 << i):
+                    offset |= delta[pos] << (8 * i)
+                    pos += 1
+            for i in range(3):
+                if op & (0x10 << i):
+                    length |= delta[pos] << (8 * i)
+                    pos += 1
+            out += base[offset:offset + (length or 0x10000)]
+        elif op:  # insert
+            out += delta[pos:pos + op]
+            pos += op
+        else:
+            raise UnsupportedRepository('Invalid delta')
+    if len(out) != size:
+        raise UnsupportedRepository('Invalid delta')
+    return bytes(out)
+
+
+class ObjectReader(object):
+
+    """
+    Read refs and objects of a git repository without running git.
+
+    Only the "files" ref backend, SHA-1 object format, loose objects
+    and version 2 pack index are supported.  `UnsupportedRepository`
+    is raised for anything else (including missing objects) so that
+    callers can fall back to git commands.
+    """
+
+    types = {1: 'commit', 2: 'tree', 3: 'blob', 4: 'tag'}
+
+    def __init__(self, path='.'):
+        (self.gitdir, self.commondir) = find_git_dirs(path)
+        self.objdir = os.path.join(self.commondir, 'objects')
+        try:
+            with open(os.path.join(self.commondir, 'config')) as file:
+                config = file.read().lower()
+        except (IOError, OSError):
+            raise UnsupportedRepository('Cannot read config')
+        if 'objectformat' in config or 'refstorage' in config or \
+                os.path.exists(os.path.join(self.objdir, 'info',
+                                            'alternates')):
+            raise UnsupportedRepository('Unsupported repository format')
+        self.packs = []
+        self._load_packs()
+
+    def _load_packs(self):
+        import glob
+        import mmap
+        loaded = set(path for (path, _, _) in self.packs)
+        for idxpath in sorted(glob.glob(os.path.join(self.objdir, 'pack',
+                                                     'pack-*.idx'))):
+            if idxpath in loaded:
+                continue
+            maps = []
+            for path in [idxpath, idxpath[:-len('.idx')] + '.pack']:
+                with open(path, 'rb') as file:
+                    maps.append(mmap.mmap(file.fileno(), 0,
+                                          access=mmap.ACCESS_READ))
+            if maps[0][:8] != b'\377tOc\0\0\0\2':
+                raise UnsupportedRepository('Unsupported pack index')
+            self.packs.append((idxpath, maps[0], maps[1]))
+
+    def close(self):
+        for (_, idx, pack) in self.packs:
+            idx.close()
+            pack.close()
+        self.packs = []
+
+    def refs(self, prefix):
+        """
+        Return a sorted list of ``(ref, sha1)`` for refs under `prefix`.
+        """
+        refs = {}
+        try:
+            with open(os.path.join(self.commondir, 'packed-refs')) as file:
+                for line in file:
+                    if line.startswith(('#', '^')):
+                        continue
+                    (sha1, ref) = line.split()
+                    if ref.startswith(prefix):
+                        refs[ref] = sha1
+        except (IOError, OSError):
+            pass
+        top = os.path.join(self.commondir, *prefix.rstrip('/').split('/'))
+        for (dirpath, _, filenames) in os.walk(top):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                with open(path) as file:
+                    sha1 = file.read().strip()
+                if len(sha1) != 40:
+                    raise UnsupportedRepository('Symbolic ref: ' + path)
+                ref = os.path.relpath(path, self.commondir)
+                refs[ref.replace(os.path.sep, '/')] = sha1
+        return sorted(refs.items())
+
+    def read(self, sha1):
+        """
+        Return a pair ``(type, data)`` of object `sha1`.
+        """
+        import binascii
+        import zlib
+        path = os.path.join(self.objdir, sha1[:2], sha1[2:])
+        if os.path.exists(path):
+            with open(path, 'rb') as file:
+                raw = zlib.decompress(file.read())
+            (header, _, data) = raw.partition(b'\0')
+            return (header.split()[0].decode(), data)
+        for retry in [False, True]:
+            if retry:
+                self._load_packs()
+            found = self._find(binascii.unhexlify(sha1))
+            if found:
+                return self._read_packed(*found)
+        raise UnsupportedRepository('Object not found: ' + sha1)
+
+    def _find(self, binsha):
+        import struct
+        for (_, idx, pack) in self.packs:
+            first = bytearray(binsha)[0]
+            lo = struct.unpack_from('>I', idx, 8 + 4 * (first - 1))[0] \
+                if first else 0
+            hi = struct.unpack_from('>I', idx, 8 + 4 * first)[0]
+            num = struct.unpack_from('>I', idx, 8 + 4 * 255)[0]
+            while lo < hi:
+                mid = (lo + hi) // 2
+                pos = 8 + 1024 + 20 * mid
+                entry = idx[pos:pos + 20]
+                if entry < binsha:
+                    lo = mid + 1
+                elif entry > binsha:
+                    hi = mid
+                else:
+                    base = 8 + 1024 + 24 * num
+                    offset = struct.unpack_from('>I', idx, base + 4 * mid)[0]
+                    if offset & 0x80000000:
+                        offset = struct.unpack_from(
+                            '>Q', idx, base + 4 * num +
+                            8 * (offset & 0x7fffffff))[0]
+                    return (pack, offset)
+        return None
+
+    def _read_packed(self, pack, offset):
+        import binascii
+        import zlib
+
+        def byte(pos):
+            return bytearray(pack[pos:pos + 1])[0]
+
+        c = byte(offset)
+        type = (c >> 4) & 7
+        pos = offset + 1
+        while c & 0x80:
+            c = byte(pos)
+            pos += 1
+        if type == 6:  # OFS_DELTA
+            c = byte(pos)
+            pos += 1
+            back = c & 0x7f
+            while c & 0x80:
+                c = byte(pos)
+                pos += 1
+                back = ((back + 1) << 7) | (c & 0x7f)
+            (type, base) = self._read_packed(pack, offset - back)
+        elif type == 7:  # REF_DELTA
+            (type, base) = self.read(
+                binascii.hexlify(pack[pos:pos + 20]).decode())
+            pos += 20
+        elif type in self.types:
+            type = self.types[type]
+            base = None
+        else:
+            raise UnsupportedRepository('Unknown pack object type')
+        inflater = zlib.decompressobj()
+        data = b''
+        while not inflater.eof:
+            chunk = pack[pos:pos + (1 << 16)]
+            if not chunk:
+                raise UnsupportedRepository('Truncated pack')
+            data += inflater.decompress(chunk)
+            pos += len(chunk)
+        if base is not None:
+            data = apply_delta(base, data)
+        return (type, data)
+
+    def read_commit(self, sha1):
+        """
+        Return a pair of the list of parents and message of commit `sha1`.
+        """
+        (type, data) = self.read(sha1)
+        if type != 'commit':
+            raise UnsupportedRepository('Not a commit: ' + sha1)
+        (header, _, message) = data.partition(b'\n\n')
+        parents = [l.split()[1].decode() for l in header.splitlines()
+                   if l.startswith(b'parent ')]
+        return (parents, message.decode())
+
+
+def trashinfo(rev, reader=None):
+    if reader:
+        (parents, message) = reader.read_commit(rev)
+        heading, obj = parse_json_message(message)
+        return dict(obj, heading=heading, rev_info=rev, rev=parents[0])
+    out = check_output(['git', 'show', '--no-patch', '--format=format:%B',
+                        rev])
     heading, obj = parse_json_message(out.decode())
     rev0 = check_output(['git', 'rev-parse', rev + '^'])
     return dict(obj, heading=heading, rev_info=rev, rev=rev0.decode().strip())
 
 
-def gettrashes():
-    out = check_output(['git', 'rev-parse', '--glob=refs/bh/trash/*'])
-    revs = out.decode().splitlines()
-    return list(map(trashinfo, revs))
+def gettrashes(reader=None, revs=None, within=None):
+    """
+    Return a list of trashes fetched to ``refs/bh/trash/``.
+
+    Trashes are read by `ObjectReader` without running git commands if
+    possible and by git commands otherwise.  An open `reader` can be
+    passed to reuse it.  Only the trash refs at `revs` are read if
+    given, and only the trash commits in `within` are read if given.
+    """
+    if reader:
+        try:
+            return _gettrashes(reader, revs, within)
+        except UnsupportedRepository:
+            return _gettrashes(None, revs, within)
+    try:
+        reader = ObjectReader()
+    except UnsupportedRepository:
+        return _gettrashes(None, revs, within)
+    try:
+        return gettrashes(reader, revs, within)
+    finally:
+        reader.close()
+
+
+def _gettrashes(reader, revs=None, within=None):
+    if revs is None and reader:
+        revs = [sha1 for (_, sha1) in reader.refs('refs/bh/trash/')]
+    elif revs is None:
+        out = check_output(['git', 'rev-parse', '--glob=refs/bh/trash/*'])
+        revs = out.decode().splitlines()
+    if within is not None:
+        revs = [rev for rev in revs if rev in within]
+    trashes = []
+    seen = set()
+    for trash in (trashinfo(rev, reader) for rev in revs):
+        if trash.get('command') == 'compact':
+            # Archive made by `git blackhole compact`; its parents are
+            # the trash commits.
+            if reader:
+                parents = reader.read_commit(trash['rev_info'])[0]
+            else:
+                parents = check_output(
+                    ['git', 'rev-parse', trash['rev_info'] + '^@']
+                ).decode().split()
+            if within is not None:
+                parents = [rev for rev in parents if rev in within]
+            archived = [trashinfo(rev, reader) for rev in parents]
+        else:
+            archived = [trash]
+        for trash in archived:
+            if trash['rev_info'] not in seen:
+                seen.add(trash['rev_info'])
+                trashes.append(trash)
+    return trashes
 
 
 def show_trashes(trashes, verbose):
@@ -340,9 +980,134 @@ def refspecs_for_stashes(num, info=None):
     return list(map(tmpl.format, range(num)))
 
 
+def refspecs_for_stash_commits(commits, info=None):
+    """
+    Compile refspecs for stashes keyed by their commit hash.
+
+    Unlike `refspecs_for_stashes`, the destination of a stash does not
+    change when new stashes are created.
+
+    >>> refspecs_for_stash_commits(['29453bf3', 'b16b0f5c'], info=dict(
+    ...     host='myhost',
+    ...     repokey='local/repo',
+    ... ))                                 # doctest: +NORMALIZE_WHITESPACE
+    ['29453bf3:refs/heads/stash/myhost/local/repo/sha1/29453bf3',
+     'b16b0f5c:refs/heads/stash/myhost/local/repo/sha1/b16b0f5c']
+
+    """
+    prefix = getprefix('stash', info=info)
+    tmpl = '{0}:refs/heads/' + prefix + '/sha1/{0}'
+    return list(map(tmpl.format, commits))
+
+
+def refspecs_for_stale_stashes(remoterefs, commits, info=None):
+    """
+    Compile refspecs deleting remote stashes not in `commits`.
+
+    Only the refs created by `refspecs_for_stashes` and
+    `refspecs_for_stash_commits` are considered, so that stashes of
+    a repository whose REPOKEY is nested under ours are not touched.
+
+    >>> refspecs_for_stale_stashes(
+    ...     ['refs/heads/stash/h/repo/0',
+    ...      'refs/heads/stash/h/repo/sub/0',
+    ...      'refs/heads/stash/h/repo/sha1/' + 'a' * 40,
+    ...      'refs/heads/stash/h/repo/sha1/' + 'b' * 40],
+    ...     ['a' * 40],
+    ...     info=dict(
+    ...         host='h',
+    ...         repokey='repo',
+    ... ))                                 # doctest: +NORMALIZE_WHITESPACE
+    [':refs/heads/stash/h/repo/0',
+     ':refs/heads/stash/h/repo/sha1/bbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbb']
+
+    """
+    import re
+    prefix = 'refs/heads/' + getprefix('stash', info=info) + '/'
+    ours = re.compile(r'(?:[0-9]+|sha1/[0-9a-f]{40})\Z').match
+    keep = set('sha1/' + c for c in commits)
+    return [':' + r for r in remoterefs
+            if r.startswith(prefix) and ours(r[len(prefix):]) and
+            r[len(prefix):] not in keep]
+
+
+def refspecs_for_stale_branches(remoterefs, branches, info=None):
+    """
+    Compile refspecs deleting remote branches not in `branches`.
+
+    Branches under a directory containing ``HEAD`` are assumed to be
+    pushed from a repository whose REPOKEY is nested under ours and
+    are not touched.
+
+    >>> refspecs_for_stale_branches(
+    ...     ['refs/heads/heads/myhost/repo/HEAD',
+    ...      'refs/heads/heads/myhost/repo/master',
+    ...      'refs/heads/heads/myhost/repo/gone',
+    ...      'refs/heads/heads/myhost/repo/feature/gone',
+    ...      'refs/heads/heads/myhost/repo/sub/HEAD',
+    ...      'refs/heads/heads/myhost/repo/sub/master'],
+    ...     ['master'],
+    ...     info=dict(
+    ...         host='myhost',
+    ...         repokey='repo',
+    ... ))                                 # doctest: +NORMALIZE_WHITESPACE
+    [':refs/heads/heads/myhost/repo/gone',
+     ':refs/heads/heads/myhost/repo/feature/gone']
+
+    """
+    prefix = 'refs/heads/' + getprefix('heads', info=info) + '/'
+    names = [r[len(prefix):] for r in remoterefs if r.startswith(prefix)]
+    nested = tuple(n[:-len('HEAD')] for n in names if n.endswith('/HEAD'))
+    keep = set(branches) | {'HEAD'}
+    return [':' + prefix + n for n in names
+            if n not in keep and not n.startswith(nested)]
+
+
+def glob_ref_prefix(pattern):
+    """
+    Return the leading directories of `pattern` not containing globs.
+
+    The result can be passed to git-for-each-ref to list (a superset
+    of) refs matching `pattern`.
+
+    >>> glob_ref_prefix('refs/wip/*')
+    'refs/wip'
+    >>> glob_ref_prefix('refs/wip/ma?ter')
+    'refs/wip'
+    >>> glob_ref_prefix('refs/wip/master')
+    'refs/wip/master'
+    >>> glob_ref_prefix('*/wip/*')
+    ''
+
+    """
+    for (i, c) in enumerate(pattern):
+        if c in '*?[':
+            return pattern[:i].rpartition('/')[0]
+    return pattern
+
+
+def compile_globs(globs):
+    """
+    Compile a list of `fnmatch` patterns into a single matcher.
+
+    >>> match = compile_globs(['refs/wip/*', 'refs/tags/v1.*'])
+    >>> bool(match('refs/wip/a/b'))
+    True
+    >>> bool(match('refs/tags/v1.0'))
+    True
+    >>> bool(match('refs/tags/v2.0'))
+    False
+
+    """
+    import fnmatch
+    import re
+    return re.compile('|'.join(
+        '(?:{0})'.format(fnmatch.translate(p)) for p in globs)).match
+
+
 def refspecs_from_globs(globs, refs=None, info=None):
     """
-    Compile refspecs for stashes and and return as a list strings.
+    Compile refspecs for refs matching `globs` and return as a list strings.
 
     >>> refspecs_from_globs(
     ...     ['refs/wip/*'],
@@ -357,23 +1122,860 @@ def refspecs_from_globs(globs, refs=None, info=None):
     ... ))                                 # doctest: +NORMALIZE_WHITESPACE
     ['refs/wip/master:refs/wip/myhost/local/repo/master']
 
+    When `refs` is not given, only the refs under the glob-free prefix
+    of each pattern are requested from git, so that the cost does not
+    grow with unrelated namespaces (e.g., ``refs/remotes/``).
+
     """
-    import fnmatch
+    if not globs:
+        return []
     info = info or getrecinfo()
-    allrefs = refs or getrefnames()
-    refs = []
-    for pattern in globs:
-        refs.extend(fnmatch.filter(allrefs, pattern))
-    refs = fnmatch.filter(refs, 'refs/*')
-    refs = [r for r in refs if not r.startswith('refs/remotes/')]
+    if refs is None:
+        prefixes = list(map(glob_ref_prefix, globs))
+        refs = getrefnames(None if '' in prefixes else prefixes)
+    match = compile_globs(globs)
     refspecs = []
+    prefixes = {}
     for r in refs:
+        if not (r.startswith('refs/') and match(r)) or \
+                r.startswith('refs/remotes/'):
+            continue
         (_, type, rest) = r.split('/', 2)
-        prefix = getprefix(type, info=info)
-        refspecs.append('{0}:refs/{1}/{2}'.format(r, prefix, rest))
+        if type not in prefixes:
+            prefixes[type] = getprefix(type, info=info)
+        refspecs.append('{0}:refs/{1}/{2}'.format(r, prefixes[type], rest))
     return refspecs
 
 
+def group_remote_heads(names):
+    """
+    Group branch `names` under ``refs/heads/heads/`` by (host, repokey).
+
+    Since ``git blackhole push`` always pushes ``HEAD``, a directory
+    containing ``HEAD`` is taken as the root of a repository.  For the
+    other branches, the last path component is taken as branch name.
+
+    >>> groups = group_remote_heads([
+    ...     'h1/repo/HEAD', 'h1/repo/master', 'h1/repo/feature/x',
+    ...     'h1/repo/sub/HEAD', 'h1/repo/sub/master',
+    ...     'h2/other/master',
+    ... ])
+    >>> for key in sorted(groups):
+    ...     print(key, groups[key])
+    ('h1', 'repo') ['HEAD', 'master', 'feature/x']
+    ('h1', 'repo/sub') ['HEAD', 'master']
+    ('h2', 'other') ['master']
+
+    """
+    roots = sorted((n[:-len('/HEAD')] for n in names if n.endswith('/HEAD')),
+                   key=len, reverse=True)
+    groups = {}
+    for name in names:
+        for root in roots:
+            if name.startswith(root + '/'):
+                break
+        else:
+            root = name.rpartition('/')[0]
+        (host, _, repokey) = root.partition('/')
+        groups.setdefault((host, repokey), []).append(name[len(root) + 1:])
+    return groups
+
+
+def read_commits(revs):
+    """
+    Return a dict mapping commits in `revs` to their headers.
+
+    Each header is a dict with keys `time` (committer time) and
+    `parents`.  Commits not available locally are omitted.  All
+    commits are read by a single ``git cat-file --batch`` process.
+    """
+    if not revs:
+        return {}
+    out = check_communicate(['git', 'cat-file', '--batch'],
+                            ''.join(r + '\n' for r in revs))
+    commits = {}
+    pos = 0
+    while pos < len(out):
+        end = out.index(b'\n', pos)
+        header = out[pos:end].decode().split()
+        pos = end + 1
+        if header[1] == 'missing':
+            continue
+        size = int(header[2])
+        body = out[pos:pos + size]
+        pos += size + 1
+        if header[1] != 'commit':
+            continue
+        commit = commits[header[0]] = dict(parents=[])
+        for line in body.split(b'\n\n', 1)[0].decode().splitlines():
+            if line.startswith('parent '):
+                commit['parents'].append(line.split()[1])
+            elif line.startswith('committer '):
+                commit['time'] = int(line.rsplit(None, 2)[-2])
+    return commits
+
+
+def update_ref_index(run, remote, refresh=False, max_age=3600):
+    """
+    Load the cached listing of ``refs/heads/heads/*`` in `remote`.
+
+    The cache is stored in ``$GIT_DIR/blackhole/refs-$REMOTE.json``
+    and is refreshed by ``git ls-remote`` if it is older than
+    `max_age` seconds or `refresh` is true.  On refresh, the time at
+    which each ref was first seen at its current revision is kept.
+
+    """
+    import time
+    path = getgitpath('blackhole/refs-{0}.json'.format(remote))
+    index = load_json(path) or {'updated': 0, 'refs': {}}
+    now = time.time()
+    if refresh or now - index['updated'] > max_age:
+        old = index['refs']
+        refs = {}
+        for (sha1, ref) in ls_remote(run, remote, 'refs/heads/heads/*'):
+            if ref in old and old[ref][0] == sha1:
+                refs[ref] = old[ref]
+            else:
+                refs[ref] = [sha1, now]
+        index = {'updated': now, 'refs': refs}
+        dump_json(path, index)
+    return index
+
+
+def getremoterepos(run, remote, **kwds):
+    """
+    List repositories in blackhole `remote` using `update_ref_index`.
+
+    Each repository is a dict with keys `host`, `repokey`, `branches`
+    (number of branches, not counting ``HEAD``) and `time`.  The
+    `time` is the commit time of the latest ``HEAD`` (or branch) if it
+    is available locally or otherwise the time it was first seen.
+
+    """
+    refs = update_ref_index(run, remote, **kwds)['refs']
+    pre = 'refs/heads/heads/'
+    groups = group_remote_heads(
+        [r[len(pre):] for r in refs if r.startswith(pre)])
+    commits = read_commits(sorted(set(sha1 for (sha1, _) in refs.values())))
+    repos = []
+    for ((host, repokey), branches) in sorted(groups.items()):
+        root = '{0}{1}/{2}/'.format(pre, host, repokey)
+        heads = [refs[root + 'HEAD']] if 'HEAD' in branches else \
+            [refs[root + b] for b in branches]
+        repos.append(dict(
+            host=host,
+            repokey=repokey,
+            branches=len([b for b in branches if b != 'HEAD']),
+            time=max(commits.get(sha1, dict(time=seen))['time']
+                     for (sha1, seen) in heads),
+        ))
+    return repos
+
+
+def parse_size(size):
+    """
+    Parse `size` with an optional binary suffix (k, m or g).
+
+    >>> parse_size('512')
+    512
+    >>> parse_size('10k')
+    10240
+    >>> parse_size('1.5M')
+    1572864
+
+    """
+    units = {'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30}
+    size = str(size).strip().lower()
+    if size[-1:] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def format_size(size):
+    """
+    Format `size` in bytes in a human readable form.
+
+    >>> format_size(512)
+    '512 B'
+    >>> format_size(1572864)
+    '1.5 MiB'
+
+    """
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if size < 1024 or unit == 'GiB':
+            break
+        size /= 1024.0
+    return ('{0} {1}' if unit == 'B' else '{0:.1f} {1}').format(size, unit)
+
+
+def estimate_push(revs, remote, known=()):
+    """
+    Estimate the objects to be sent when pushing `revs` to `remote`.
+
+    Objects reachable from remote-tracking refs of `remote` and from
+    `known` revisions (which may not exist locally) are assumed to be
+    in `remote` already.  Return a pair of the number of objects and
+    their size on disk (which approximates the size of the pack).
+
+    """
+    out = check_communicate(
+        ['git', 'rev-list', '--objects', '--no-object-names',
+         '--ignore-missing', '--stdin', '--not', '--remotes=' + remote],
+        ''.join(r + '\n' for r in revs) +
+        ''.join('^' + r + '\n' for r in known))
+    if not out:
+        return (0, 0)
+    sizes = check_communicate(
+        ['git', 'cat-file', '--batch-check=%(objectsize:disk)'], out).split()
+    return (len(sizes), sum(map(int, sizes)))
+
+
+def count_unpushed(revs, remote, known=()):
+    """
+    Count commits reachable from each of `revs` but not from `remote`.
+
+    Commits are assumed to be in `remote` in the same way as
+    `estimate_push`.  All counts are computed from a single
+    ``git rev-list``.  Return a list of counts in the order of `revs`.
+
+    """
+    out = check_communicate(
+        ['git', 'rev-list', '--parents', '--ignore-missing', '--stdin',
+         '--not', '--remotes=' + remote],
+        ''.join(r + '\n' for r in revs) +
+        ''.join('^' + r + '\n' for r in known))
+    parents = {}
+    for line in out.decode().splitlines():
+        commits = line.split()
+        parents[commits[0]] = commits[1:]
+    counts = []
+    for rev in revs:
+        seen = set()
+        stack = [rev]
+        while stack:
+            commit = stack.pop()
+            if commit in parents and commit not in seen:
+                seen.add(commit)
+                stack.extend(parents[commit])
+        counts.append(len(seen))
+    return counts
+
+
+def pushrecordpath(remote):
+    return getgitpath('blackhole/pushed-{0}.json'.format(remote))
+
+
+def plan_push(refspecs, prefix):
+    """
+    Resolve source and destination of `refspecs` for ``git push``.
+
+    Return a list of ``(refspec, dst, sha1)``.  Bare branch names are
+    mapped to ``refs/heads/<prefix>/<branch>`` as in the push refspec
+    configured by ``git blackhole init``.  `sha1` is `None` for
+    deletions and unresolvable sources.
+
+    """
+    srcs = [r.split(':', 1)[0] for r in refspecs]
+    out = check_communicate(
+        ['git', 'cat-file', '--batch-check=%(objectname)'],
+        ''.join(s + '\n' for s in srcs if s)).decode().splitlines()
+    plan = []
+    for (spec, src) in zip(refspecs, srcs):
+        if ':' in spec:
+            dst = spec.split(':', 1)[1]
+        else:
+            dst = 'refs/heads/{0}/{1}'.format(prefix, spec)
+        sha1 = None
+        if src:
+            sha1 = out.pop(0)
+            if sha1.endswith(' missing'):
+                sha1 = None
+        plan.append((spec, dst, sha1))
+    return plan
+
+
+def count_updated_refs(record, plan):
+    """
+    Count refs in `plan` whose revision differs from `record`.
+
+    >>> count_updated_refs({'refs/a': '1', 'refs/b': '2'},
+    ...                    [('a', 'refs/a', '1'), ('b', 'refs/b', '3'),
+    ...                     (':refs/c', 'refs/c', None)])
+    1
+
+    """
+    return sum(1 for (_, dst, sha1) in plan
+               if record.get(dst) != sha1 and (sha1 or dst in record))
+
+
+def update_push_record(remote, plan):
+    path = pushrecordpath(remote)
+    record = load_json(path, {})
+    for (_, dst, sha1) in plan:
+        if sha1:
+            record[dst] = sha1
+        else:
+            record.pop(dst, None)
+    dump_json(path, record)
+
+
+def throttled_ssh_command(rate):
+    """
+    Return ``GIT_SSH_COMMAND`` limiting upload bandwidth to `rate`.
+    """
+    from shlex import quote
+    base = os.environ.get('GIT_SSH_COMMAND') or \
+        getconfig('core.sshCommand') or 'ssh'
+    return ' '.join(map(quote, [
+        sys.executable, os.path.abspath(__file__), '--throttle-ssh',
+        str(rate), base]))
+
+
+def throttle_ssh(rate, command, *args):
+    """
+    Run ssh `command` while sending stdin at most `rate` bytes per second.
+    """
+    import time
+    from subprocess import Popen, PIPE
+    proc = Popen(['sh', '-c', command + ' "$@"', command] + list(args),
+                 stdin=PIPE)
+    start = time.time()
+    sent = 0
+    try:
+        while True:
+            data = os.read(0, 1 << 14)
+            if not data:
+                break
+            proc.stdin.write(data)
+            proc.stdin.flush()
+            sent += len(data)
+            delay = sent / float(rate) - (time.time() - start)
+            if delay > 0:
+                time.sleep(delay)
+        proc.stdin.close()
+    except (IOError, OSError):
+        pass
+    return proc.wait()
+
+
+_ssh_multiplex_command = None
+
+
+def start_ssh_multiplexing():
+    """
+    Share one SSH connection per host among the git commands to be run.
+
+    ``GIT_SSH_COMMAND`` is set to use OpenSSH connection multiplexing
+    with control sockets in a temporary directory.  Return a function
+    which closes the connections and restores the environment.
+    Nothing is changed if ssh is configured by ``GIT_SSH``,
+    ``GIT_SSH_COMMAND`` or ``core.sshCommand``, or if config
+    ``blackhole.sshMultiplex`` is false.  The command set is recorded
+    so that `spawn_background` does not pass it to detached processes
+    which outlive the connections.
+
+    """
+    import shutil
+    import tempfile
+    from subprocess import call
+    if os.environ.get('GIT_SSH') or os.environ.get('GIT_SSH_COMMAND') or \
+            getconfig('core.sshCommand') or \
+            (getconfig('blackhole.sshMultiplex') or '').lower() in (
+                'false', 'no', 'off', '0'):
+        return lambda: None
+    # Use a short path since control socket paths are limited to about
+    # 100 bytes:
+    global _ssh_multiplex_command
+    tmpdir = tempfile.mkdtemp(prefix='bh-ssh-',
+                              dir='/tmp' if os.path.isdir('/tmp') else None)
+    _ssh_multiplex_command = os.environ['GIT_SSH_COMMAND'] = ' '.join([
+        'ssh', '-o', 'ControlMaster=auto',
+        '-o', 'ControlPath={0}/%C'.format(tmpdir),
+        '-o', 'ControlPersist=60'])
+
+    def stop():
+        global _ssh_multiplex_command
+        _ssh_multiplex_command = None
+        del os.environ['GIT_SSH_COMMAND']
+        with open(os.devnull, 'w') as devnull:
+            for name in os.listdir(tmpdir):
+                call(['ssh', '-o', 'ControlPath=' + os.path.join(tmpdir, name),
+                      '-O', 'exit', 'localhost'],
+                     stdout=devnull, stderr=devnull)
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    return stop
+
+
+HOOK_MARKER = '# Installed by git blackhole install-hook.'
+
+HOOK_TEMPLATE = """\
+#!/bin/sh
+{marker}
+if [ -x "$0.pre-blackhole" ]; then
+    "$0.pre-blackhole" "$@" || exit $?
+fi
+# Start Python only if the blackhole is configured and no push started
+# by this hook is pending (a pending marker older than 10 minutes is
+# considered stale):
+git config remote.{remote}.url > /dev/null || exit 0
+if [ -n "$(find {pending} -mmin -10 2> /dev/null)" ]; then
+    exit 0
+fi
+mkdir -p {pendingdir} && : > {pending}
+GIT_BLACKHOLE_PENDING={pending}
+export GIT_BLACKHOLE_PENDING
+exec git blackhole push --background --no-verify --remote {remote}
+"""
+
+
+def cli_install_hook(hooks, remote, uninstall, verbose, dry_run):
+    """
+    Install hooks running ``git blackhole push --background``.
+
+    The hook is a shell script which starts ``git blackhole`` only when
+    the blackhole `remote` is configured and a push started by the hook
+    is not pending yet (i.e., the background push has not started),
+    so that the hook costs only a few milliseconds otherwise.
+    ``git-blackhole`` is found through ``$PATH`` as other git commands
+    are.  An existing hook is renamed to ``<hook>.pre-blackhole`` and called
+    from the installed hook.  Use ``--uninstall`` to restore it.
+
+    """
+    from shlex import quote
+    hooks = hooks or ['post-commit']
+    hooksdir = getgitpath('hooks')
+    pending = os.path.abspath(getgitpath('blackhole/push-pending'))
+    for hook in hooks:
+        path = os.path.join(hooksdir, hook)
+        chained = path + '.pre-blackhole'
+        installed = False
+        if os.path.exists(path):
+            with open(path) as file:
+                installed = HOOK_MARKER in file.read()
+        if uninstall:
+            if not installed:
+                print('{0} is not installed by git blackhole.'.format(path))
+                continue
+            if verbose:
+                print('rm', path)
+            if not dry_run:
+                os.remove(path)
+                if os.path.exists(chained):
+                    os.rename(chained, path)
+            continue
+        if os.path.exists(path) and not installed:
+            if os.path.exists(chained):
+                raise BlackholeError('{0} already exists.'.format(chained))
+            if verbose:
+                print('mv', path, chained)
+            if not dry_run:
+                os.rename(path, chained)
+        if verbose:
+            print('write', path)
+        if not dry_run:
+            if not os.path.isdir(hooksdir):
+                os.makedirs(hooksdir)
+            write_atomically(path, HOOK_TEMPLATE.format(
+                marker=HOOK_MARKER, remote=quote(remote),
+                pending=quote(pending),
+                pendingdir=quote(os.path.dirname(pending))))
+            os.chmod(path, 0o755)
+
+
+LOW_IMPACT_CONFIG = [
+    ('pack.threads', '1'),
+    ('pack.compression', '1'),
+]
+
+
+def spawn_background(args, logfile, maxlog=1 << 20):
+    """
+    Run ``git blackhole <args>`` detached, at low CPU and IO priority.
+
+    The output and exit status are appended to `logfile`, which is
+    rotated when it gets larger than `maxlog` bytes.  Git subprocesses
+    use `LOW_IMPACT_CONFIG` to reduce CPU usage of pack generation.
+
+    """
+    import time
+    from shlex import quote
+    from shutil import which
+    from subprocess import DEVNULL, Popen, STDOUT
+    dirpath = os.path.dirname(logfile)
+    if dirpath and not os.path.isdir(dirpath):
+        os.makedirs(dirpath)
+    if os.path.exists(logfile) and os.path.getsize(logfile) > maxlog:
+        os.replace(logfile, logfile + '.1')
+
+    env = dict(os.environ)
+    if _ssh_multiplex_command and \
+            env.get('GIT_SSH_COMMAND') == _ssh_multiplex_command:
+        # The connections are closed when we exit; let the process
+        # set up its own:
+        del env['GIT_SSH_COMMAND']
+    count = int(env.get('GIT_CONFIG_COUNT', 0))
+    for (i, (key, value)) in enumerate(LOW_IMPACT_CONFIG, count):
+        env['GIT_CONFIG_KEY_{0}'.format(i)] = key
+        env['GIT_CONFIG_VALUE_{0}'.format(i)] = value
+    env['GIT_CONFIG_COUNT'] = str(count + len(LOW_IMPACT_CONFIG))
+
+    cmd = ['sh', '-c', '"$@"; echo "exit status: $?"', 'sh',
+           sys.executable, os.path.abspath(__file__)] + list(args)
+    if which('ionice'):
+        cmd = ['ionice', '-c', '3'] + cmd
+    with open(logfile, 'a') as log:
+        log.write('[{0}] git blackhole {1}\n'.format(
+            time.strftime('%Y-%m-%d %H:%M:%S'), ' '.join(map(quote, args))))
+        log.flush()
+        proc = Popen(cmd, stdin=DEVNULL, stdout=log, stderr=STDOUT,
+                     env=env, close_fds=True, start_new_session=True,
+                     preexec_fn=lambda: os.nice(19))
+    return proc.pid
+
+
+DURATION_BUCKETS = (0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+METRICS = [
+    # (name, type, help)
+    ('push_total', 'counter', 'Number of git blackhole push runs.'),
+    ('push_failures_total', 'counter', 'Number of failed push runs.'),
+    ('push_refs_updated_total', 'counter', 'Number of refs updated by push.'),
+    ('push_bytes_total', 'counter', 'Estimated bytes sent by push.'),
+    ('trash_total', 'counter', 'Number of trashed branches and stashes.'),
+    ('push_duration_seconds', 'histogram', 'Duration of push runs.'),
+    ('last_push_timestamp_seconds', 'gauge', 'Time of the last push.'),
+    ('last_success_timestamp_seconds', 'gauge',
+     'Time of the last successful push.'),
+]
+
+
+def getmetricspaths():
+    """
+    Return paths to the JSON stats file and Prometheus textfile.
+
+    They are configured by ``blackhole.statsFile`` and
+    ``blackhole.promFile``.  When only the latter is configured, the
+    stats are stored in ``$PROMFILE.json``.  Return `None` if neither
+    is configured.
+
+    """
+    statsfile = getconfig('blackhole.statsFile')
+    promfile = getconfig('blackhole.promFile')
+    if not (statsfile or promfile):
+        return None
+    if promfile:
+        promfile = os.path.expanduser(promfile)
+    statsfile = os.path.expanduser(statsfile) if statsfile else \
+        promfile + '.json'
+    return (statsfile, promfile)
+
+
+def update_metrics(repo, counts=None, duration=None, success=None):
+    """
+    Add `counts` to the cumulative metrics of `repo`.
+
+    The stats file is updated under a lock so that concurrent pushes
+    do not lose updates.  Both files are replaced atomically.
+    Do nothing if metrics are not configured (see `getmetricspaths`).
+
+    """
+    import time
+    paths = getmetricspaths()
+    if not paths:
+        return
+    (statsfile, promfile) = paths
+    lockfile = statsfile + '.lock'
+    dirpath = os.path.dirname(lockfile)
+    if dirpath and not os.path.isdir(dirpath):
+        os.makedirs(dirpath)
+    with open(lockfile, 'a') as lock:
+        try:
+            import fcntl
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        except ImportError:
+            pass
+        stats = load_json(statsfile, {})
+        metrics = stats.setdefault(repo, {})
+        for (name, value) in (counts or {}).items():
+            metrics[name] = metrics.get(name, 0) + value
+        now = time.time()
+        if duration is not None:
+            hist = metrics.setdefault('push_duration_seconds', dict(
+                buckets=[0] * len(DURATION_BUCKETS), sum=0, count=0))
+            for (i, le) in enumerate(DURATION_BUCKETS):
+                if duration <= le:
+                    hist['buckets'][i] += 1
+            hist['sum'] += duration
+            hist['count'] += 1
+            metrics['last_push_timestamp_seconds'] = now
+        if success:
+            metrics['last_success_timestamp_seconds'] = now
+        dump_json(statsfile, stats)
+        if promfile:
+            write_atomically(promfile, render_prometheus(stats))
+
+
+def write_atomically(path, text):
+    import tempfile
+    dirpath = os.path.dirname(path)
+    (fd, tmppath) = tempfile.mkstemp(dir=dirpath or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as file:
+            file.write(text)
+        os.chmod(tmppath, 0o644)
+        os.replace(tmppath, path)
+    except BaseException:
+        os.remove(tmppath)
+        raise
+
+
+def render_prometheus(stats, namespace='git_blackhole'):
+    """
+    Render `stats` in the Prometheus text format.
+
+    >>> print(render_prometheus({'/repo': {
+    ...     'push_total': 2,
+    ...     'push_duration_seconds': dict(
+    ...         buckets=[1, 2, 2, 2, 2, 2, 2, 2], sum=1.5, count=2),
+    ... }}), end='')
+    ... # doctest: +ELLIPSIS
+    # HELP git_blackhole_push_total Number of git blackhole push runs.
+    # TYPE git_blackhole_push_total counter
+    git_blackhole_push_total{repo="/repo"} 2
+    # HELP git_blackhole_push_duration_seconds Duration of push runs.
+    # TYPE git_blackhole_push_duration_seconds histogram
+    git_blackhole_push_duration_seconds_bucket{repo="/repo",le="0.5"} 1
+    git_blackhole_push_duration_seconds_bucket{repo="/repo",le="1"} 2
+    ...
+    git_blackhole_push_duration_seconds_bucket{repo="/repo",le="+Inf"} 2
+    git_blackhole_push_duration_seconds_sum{repo="/repo"} 1.5
+    git_blackhole_push_duration_seconds_count{repo="/repo"} 2
+
+    """
+    lines = []
+    for (name, type, help) in METRICS:
+        repos = sorted(r for r in stats if name in stats[r])
+        if not repos:
+            continue
+        fullname = '{0}_{1}'.format(namespace, name)
+        lines.append('# HELP {0} {1}'.format(fullname, help))
+        lines.append('# TYPE {0} {1}'.format(fullname, type))
+        for repo in repos:
+            label = 'repo="{0}"'.format(
+                repo.replace('\\', '\\\\').replace('"', '\\"')
+                .replace('\n', '\\n'))
+            value = stats[repo][name]
+            if type != 'histogram':
+                lines.append('{0}{{{1}}} {2}'.format(fullname, label, value))
+                continue
+            for (le, count) in zip(DURATION_BUCKETS, value['buckets']):
+                lines.append('{0}_bucket{{{1},le="{2}"}} {3}'.format(
+                    fullname, label, le, count))
+            lines.append('{0}_bucket{{{1},le="+Inf"}} {2}'.format(
+                fullname, label, value['count']))
+            lines.append('{0}_sum{{{1}}} {2}'.format(
+                fullname, label, value['sum']))
+            lines.append('{0}_count{{{1}}} {2}'.format(
+                fullname, label, value['count']))
+    return ''.join(l + '\n' for l in lines)
+
+
+WATCH_IGNORE = ('remotes', 'bh', 'prefetch')
+
+
+def ref_snapshot(gitdir, commondir):
+    """
+    Return modification times of the files storing refs in a repository.
+
+    Remote-tracking branches and refs under ``refs/bh/`` are ignored so
+    that ``git blackhole`` itself does not trigger a change.
+
+    """
+    paths = [os.path.join(gitdir, 'HEAD'),
+             os.path.join(commondir, 'packed-refs'),
+             os.path.join(commondir, 'logs', 'refs', 'stash')]
+    refsdir = os.path.join(commondir, 'refs')
+    for (dirpath, dirnames, filenames) in os.walk(refsdir):
+        if dirpath == refsdir:
+            dirnames[:] = [d for d in dirnames if d not in WATCH_IGNORE]
+        paths.extend(os.path.join(dirpath, f) for f in filenames)
+    snapshot = {}
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        snapshot[path] = (stat.st_mtime, stat.st_size)
+    return snapshot
+
+
+def make_ref_poller(repos, interval=1.0):
+    """
+    Make a function waiting for changes of refs in `repos` by polling.
+
+    `repos` is a dict mapping a worktree to a pair of its git
+    directory and common directory.  The returned function takes a
+    timeout (`None` to wait forever) and returns a set of the
+    worktrees whose refs are changed.
+
+    """
+    import time
+    snapshots = dict((r, ref_snapshot(*d)) for (r, d) in repos.items())
+
+    def wait(timeout):
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            changed = set()
+            for (repo, dirs) in repos.items():
+                snapshot = ref_snapshot(*dirs)
+                if snapshot != snapshots[repo]:
+                    snapshots[repo] = snapshot
+                    changed.add(repo)
+            if changed:
+                return changed
+            if deadline is not None and time.time() >= deadline:
+                return changed
+            time.sleep(interval if deadline is None else
+                       max(0, min(interval, deadline - time.time())))
+    return wait
+
+
+def make_ref_inotify(repos):
+    """
+    Like `make_ref_poller` but use inotify(7).
+
+    Raise `OSError` if inotify is not available.
+    """
+    import ctypes
+    import ctypes.util
+    import select
+    import struct
+    import time
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    if not hasattr(libc, 'inotify_init1'):
+        raise OSError('inotify is not available')
+    (IN_CLOSE_WRITE, IN_MOVED_TO, IN_CREATE, IN_DELETE, IN_ISDIR) = (
+        0x8, 0x80, 0x100, 0x200, 0x40000000)
+    mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+    # Map a watch descriptor to (worktree, directory, accepted names):
+    watches = {}
+
+    def add(repo, path, names=None):
+        wd = libc.inotify_add_watch(fd, path.encode(), mask)
+        if wd >= 0:
+            watches[wd] = (repo, path, names)
+
+    def add_refs(repo, path):
+        for (dirpath, dirnames, _) in os.walk(path):
+            add(repo, dirpath)
+            if os.path.basename(dirpath) == 'refs':
+                dirnames[:] = [d for d in dirnames if d not in WATCH_IGNORE]
+
+    for (repo, (gitdir, commondir)) in repos.items():
+        if commondir == gitdir:
+            add(repo, gitdir, ('HEAD', 'packed-refs'))
+        else:
+            add(repo, gitdir, ('HEAD',))
+            add(repo, commondir, ('packed-refs',))
+        add(repo, os.path.join(commondir, 'logs', 'refs'), ('stash',))
+        add_refs(repo, os.path.join(commondir, 'refs'))
+
+    def wait(timeout):
+        deadline = None if timeout is None else time.time() + timeout
+        changed = set()
+        while not changed:
+            remaining = None if deadline is None else deadline - time.time()
+            if remaining is not None and remaining <= 0 or \
+                    not select.select([fd], [], [], remaining)[0]:
+                break
+            changed = read_events()
+        return changed
+
+    def read_events():
+        changed = set()
+        data = os.read(fd, 1 << 16)
+        pos = 0
+        while pos < len(data):
+            (wd, evmask, _, size) = struct.unpack_from('iIII', data, pos)
+            pos += 16
+            name = data[pos:pos + size].rstrip(b'\0').decode()
+            pos += size
+            if wd == -1:  # event queue overflowed
+                changed.update(repos)
+            if wd not in watches or name.endswith('.lock'):
+                continue
+            (repo, path, names) = watches[wd]
+            if names is not None:
+                if name in names:
+                    changed.add(repo)
+            elif os.path.basename(path) == 'refs' and name in WATCH_IGNORE:
+                continue
+            else:
+                if evmask & IN_ISDIR and evmask & IN_CREATE:
+                    add_refs(repo, os.path.join(path, name))
+                changed.add(repo)
+        return changed
+    return wait
+
+
+def cli_watch(repos, quiet_period, interval, remote, ref_globs,
+              verbose, dry_run, timeout=None, _rounds=None, **kwds):
+    """
+    Push to the blackhole whenever refs in `repos` are changed.
+
+    This is an alternative to calling ``git blackhole push`` from
+    hooks.  Changes of branches, HEAD and stashes in the repositories
+    are watched using inotify(7) (or by polling every ``--interval``
+    seconds if it is not available).  Once refs stop changing for
+    ``--quiet-period`` seconds, a single push is run for each changed
+    repository.  Thus, for example, a rebase results in only one push.
+    The global option ``--timeout`` applies to each push.
+
+    """
+    cwd = os.getcwd()
+    dirs = {}
+    for repo in (repos or ['.']):
+        out = check_output(['git', 'rev-parse', '--show-toplevel',
+                            '--absolute-git-dir', '--git-common-dir'],
+                           cwd=repo).decode().splitlines()
+        dirs[out[0]] = (out[1], os.path.abspath(os.path.join(repo, out[2])))
+    try:
+        wait = make_ref_inotify(dirs)
+    except OSError:
+        wait = make_ref_poller(dirs, interval)
+
+    changed = set(dirs)
+    rounds = 0
+    while True:
+        for repo in sorted(changed):
+            print('Pushing', repo)
+            sys.stdout.flush()
+            previous = set_deadline(timeout)
+            try:
+                os.chdir(repo)
+                cli_push(verbose=verbose, dry_run=dry_run,
+                         ref_globs=ref_globs, remote=remote,
+                         skip_if_no_blackhole=True, **kwds)
+            except (BlackholeError, CalledProcessError) as err:
+                print(err)
+            finally:
+                set_deadline(deadline=previous)
+                os.chdir(cwd)
+        rounds += 1
+        if _rounds is not None and rounds >= _rounds:
+            return
+        changed = wait(None)
+        while True:
+            more = wait(quiet_period)
+            if not more:
+                break
+            changed |= more
+
+
 def mangle_relpath(relpath):
     """
     Mangle a path `relpath` so that it can be used for git branch name.
@@ -438,9 +2040,25 @@ def cli_init(name, url, verbose, dry_run, repokey=None, mangle='default',
         run('git', 'config', 'blackhole.{}.repokey'.format(name), repokey)
 
 
-def cli_warp(host, repokey, name, remote, url, **kwds):
+def cli_warp(host, repokey, name, remote, url, branches=(), filter=None,
+             prefetch=False, **kwds):
     """
     Peek into other repositories through the blackhole.
+
+    Use ``git blackhole ls-repos`` to find available HOST and REPOKEY.
+
+    By default, all branches of the repository are fetched by ``git
+    fetch``.  Use ``--branch`` (e.g., ``--branch HEAD``) to fetch only
+    the given branches.  With ``--filter`` (default: ``blob:none``),
+    the remote is configured as a promisor remote of partial clone so
+    that ``git fetch`` skips the filtered objects and they are fetched
+    on demand.  The blackhole repository has to allow it by setting
+    ``uploadpack.allowFilter``.
+
+    With ``--prefetch``, the remote is fetched in background by ``git
+    blackhole prefetch`` (see its help) so that ``git fetch`` only has
+    to update the refs.
+
     """
     if not (host or repokey):
         print('need HOST or --repokey=REPOKEY')
@@ -459,11 +2077,273 @@ def cli_warp(host, repokey, name, remote, url, **kwds):
     prefix = getprefix('heads', info)
     if not name:
         name = 'bh_' + host
-    return cli_init(_prefix=prefix, name=name, url=url, **kwds)
+    code = cli_init(_prefix=prefix, name=name, url=url, **kwds)
+    if code:
+        return code
+
+    run = make_run(kwds['verbose'], kwds['dry_run'])
+    if branches:
+        key = 'remote.{0}.fetch'.format(name)
+        for (i, branch) in enumerate(branches):
+            run('git', 'config', *(['--add'] if i else []) + [
+                key, '+refs/heads/{0}/{1}:refs/remotes/{2}/{1}'.format(
+                    prefix, branch, name)])
+    if filter:
+        run('git', 'config', 'remote.{0}.promisor'.format(name), 'true')
+        run('git', 'config', 'remote.{0}.partialclonefilter'.format(name),
+            filter)
+    if prefetch:
+        run('git', 'config', 'blackhole.{0}.prefetch'.format(name), 'true')
+
+
+PREFETCH_INTERVAL = 600
+
+
+def prefetch_remotes():
+    """
+    Return names of the remotes with config ``blackhole.$NAME.prefetch``.
+    """
+    try:
+        out = check_output(['git', 'config', '--null', '--type=bool',
+                            '--get-regexp', r'^blackhole\..*\.prefetch$'])
+    except CalledProcessError as err:
+        if err.returncode == 1:
+            return []
+        raise
+    remotes = []
+    for entry in out.decode().split('\0')[:-1]:
+        (key, value) = entry.split('\n', 1)
+        if value == 'true':
+            remotes.append(key[len('blackhole.'):-len('.prefetch')])
+    return remotes
+
+
+def prefetchrecordpath():
+    return getgitpath('blackhole/prefetched.json')
+
+
+def due_prefetch_remotes(remotes, min_interval):
+    import time
+    record = load_json(prefetchrecordpath(), {})
+    now = time.time()
+    return [r for r in remotes if now - record.get(r, 0) >= min_interval]
+
+
+def schedule_prefetch():
+    """
+    Start ``git blackhole prefetch`` in background if any remote is due.
+    """
+    remotes = prefetch_remotes()
+    if not remotes:
+        return
+    interval = float(getconfig('blackhole.prefetchInterval') or
+                     PREFETCH_INTERVAL)
+    if due_prefetch_remotes(remotes, interval):
+        return spawn_background(
+            ['prefetch', '--min-interval', str(interval)],
+            getgitpath('blackhole/prefetch.log'))
+
+
+def cli_prefetch(remotes, min_interval, verbose, dry_run):
+    """
+    Fetch remotes created by ``git blackhole warp`` in advance.
+
+    The objects are fetched by ``git fetch --prefetch`` which writes
+    the refs under ``refs/prefetch/`` instead of the remote-tracking
+    branches.  Thus, a later ``git fetch`` (e.g., after ``git
+    blackhole warp``) only has to move the refs.
+
+    Without REMOTE, the remotes with config ``blackhole.$NAME.prefetch``
+    (set by ``git blackhole warp --prefetch``) are fetched.  Remotes
+    fetched within ``--min-interval`` seconds are skipped.  When any
+    remote is configured, ``git blackhole push`` runs this command in
+    background with ``--min-interval`` of config
+    ``blackhole.prefetchInterval`` (default: 600).  To prefetch on a
+    schedule, run it from, e.g., `crontab(5)`.
+
+    """
+    import time
+    run = make_run(verbose, dry_run, check=False)
+    if not remotes:
+        remotes = prefetch_remotes()
+    remotes = due_prefetch_remotes(remotes, min_interval)
+    code = 0
+    fetched = []
+    for remote in remotes:
+        start = time.time()
+        rcode = run('git', 'fetch', '--prefetch', '--quiet', remote)
+        if not rcode:
+            fetched.append((remote, start))
+        code = code or rcode
+    if fetched and not dry_run:
+        path = prefetchrecordpath()
+        record = load_json(path, {})
+        record.update(fetched)
+        dump_json(path, record)
+    return code
+
+
+def own_refnames(type, names):
+    """
+    Select `names` of refs pushed from the repository itself.
+
+    `names` are relative to ``<type>/$HOST/$REPOKEY/`` in the blackhole.
+    Refs of repositories whose REPOKEY is nested under it are dropped:
+    as in `group_remote_heads`, a directory containing ``HEAD`` is the
+    root of another repository for branches; stashes and trashes are
+    recognized by the names ``git blackhole`` gives them.
+
+    >>> own_refnames('heads', ['HEAD', 'master', 'sub/HEAD', 'sub/x'])
+    ['HEAD', 'master']
+    >>> own_refnames('stash', ['0', 'sha1/' + 'a' * 40, 'sub/0'])
+    ['0', 'sha1/aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa']
+    >>> own_refnames('trash', ['ab/' + 'c' * 38, 'sub/ab/' + 'c' * 38])
+    ['ab/cccccccccccccccccccccccccccccccccccccc']
+
+    """
+    import re
+    if type == 'heads':
+        nested = tuple(n[:-len('HEAD')] for n in names if n.endswith('/HEAD'))
+        return [n for n in names if not n.startswith(nested)]
+    ours = re.compile({
+        'stash': r'(?:[0-9]+|sha1/[0-9a-f]{40})\Z',
+        'trash': r'[0-9a-f]{2}/[0-9a-f]{38}\Z',
+    }[type]).match
+    return [n for n in names if ours(n)]
+
+
+def namespace_refspecs(info, local, refs, push=False):
+    """
+    Map refs of all types for `info` in the blackhole to `local` refs.
+
+    `refs` are the names of existing refs in the blackhole (or under
+    `local` if `push` is true).  Refs of repositories whose REPOKEY is
+    nested under ``info['repokey']`` are excluded (see `own_refnames`).
+
+    >>> for spec in namespace_refspecs(
+    ...         dict(host='myhost', repokey='repo'), 'refs/bh/export',
+    ...         ['refs/heads/heads/myhost/repo/HEAD',
+    ...          'refs/heads/heads/myhost/repo/sub/HEAD',
+    ...          'refs/heads/stash/myhost/repo/0',
+    ...          'refs/heads/stash/myhost/repo/sub/0']):
+    ...     print(spec)
+    +refs/heads/heads/myhost/repo/HEAD:refs/bh/export/heads/HEAD
+    +refs/heads/stash/myhost/repo/0:refs/bh/export/stash/0
+
+    The refspecs are reversed if `push` is true.
+
+    """
+    specs = []
+    for type in ['heads', 'stash', 'trash']:
+        (src, dst) = ('refs/heads/{0}/'.format(getprefix(type, info)),
+                      '{0}/{1}/'.format(local, type))
+        if push:
+            (src, dst) = (dst, src)
+        names = [r[len(src):] for r in refs if r.startswith(src)]
+        for name in own_refnames(type, names):
+            specs.append('+{0}{2}:{1}{2}'.format(src, dst, name))
+    return specs
+
+
+def cli_export(file, remote, host, repokey, since, verbose, dry_run):
+    """
+    Write backups and trashes of a repository to a bundle `file`.
+
+    Branches, stashes and trashes of HOST and REPOKEY (default:
+    current repository) in the blackhole `remote` are fetched to
+    ``refs/bh/export/`` and written to a single ``git bundle``.  Those
+    of repositories whose REPOKEY is nested under REPOKEY are not
+    included.  With
+    ``--since``, objects already in the previous bundle are omitted.
+    Use ``git blackhole import`` to load the bundle into a blackhole.
+
+    """
+    run = make_run(verbose, dry_run)
+    info = getrecinfo(remote)
+    info.update(host=host or info['host'], repokey=repokey or info['repokey'])
+    refs = [r for (_, r) in ls_remote(run, remote, *[
+        'refs/heads/{0}/*'.format(getprefix(type, info))
+        for type in ['heads', 'stash', 'trash']])]
+    specs = namespace_refspecs(info, 'refs/bh/export', refs)
+    wanted = set(spec.split(':', 1)[1] for spec in specs)
+    stale = [r for r in getrefnames(['refs/bh/export/']) if r not in wanted]
+    if stale:
+        run('git', 'update-ref', '--stdin',
+            input=''.join('delete {0}\n'.format(r) for r in stale))
+    if specs:
+        run('git', 'fetch', '--no-write-fetch-head', remote, *specs)
+    exclude = []
+    if since:
+        out = check_output(['git', 'bundle', 'list-heads', since])
+        heads = sorted(set(l.split()[0] for l in out.decode().splitlines()))
+        out = check_communicate(
+            ['git', 'cat-file', '--batch-check=%(objectname)'],
+            ''.join(h + '\n' for h in heads)).decode().splitlines()
+        exclude = ['^' + h for h in out if ' ' not in h]
+    stdin = ''.join(r + '\n' for r in exclude)
+    count = check_communicate(
+        ['git', 'rev-list', '--count', '--glob=refs/bh/export/*', '--stdin'],
+        stdin)
+    if not int(count):
+        print('Nothing to export.')
+        return 1
+    run('git', 'bundle', 'create', file, '--glob=refs/bh/export/*',
+        '--stdin', input=stdin)
+
+
+def cli_import(file, remote, host, repokey, verbose, dry_run):
+    """
+    Load a bundle made by ``git blackhole export`` into a blackhole.
+
+    Refs in the bundle are pushed to the blackhole `remote` as the
+    branches, stashes and trashes of HOST and REPOKEY (default: current
+    repository) with a single ``git push``.  Objects which an
+    incremental bundle depends on must exist in the local repository.
+
+    """
+    run = make_run(verbose, dry_run)
+    info = getrecinfo(remote)
+    info.update(host=host or info['host'], repokey=repokey or info['repokey'])
+    run('git', 'fetch', '--no-write-fetch-head', file,
+        '+refs/bh/export/*:refs/bh/import/*')
+    try:
+        specs = namespace_refspecs(info, 'refs/bh/import',
+                                   getrefnames(['refs/bh/import/']),
+                                   push=True)
+        if specs:
+            run('git', 'push', remote, *specs)
+    finally:
+        refs = getrefnames(['refs/bh/import/'])
+        if refs:
+            run('git', 'update-ref', '--stdin',
+                input=''.join('delete {0}\n'.format(r) for r in refs))
+
+
+def cli_ls_repos(remote, host, refresh, max_age, verbose, dry_run):
+    """
+    List hosts and repositories pushed to the blackhole.
+
+    Each line shows HOST, REPOKEY, the number of branches and the time
+    of the latest HEAD, which can be used for ``git blackhole warp``.
+    The listing of the remote refs is cached in the local repository
+    and fetched again only when it is older than ``--max-age``.
+
+    """
+    import time
+    run = make_run(verbose, dry_run)
+    repos = getremoterepos(run, remote, refresh=refresh, max_age=max_age)
+    for repo in repos:
+        if host and repo['host'] != host:
+            continue
+        print('{host}\t{repokey}\t{branches}\t{0}'.format(
+            time.strftime('%Y-%m-%d %H:%M', time.localtime(repo['time'])),
+            **repo))
 
 
 def cli_push(verbose, dry_run, ref_globs, remote, skip_if_no_blackhole,
-             **kwds):
+             stash_key='index', prune=False, max_prune=20,
+             max_push_size=None, oversized='defer', bwlimit=None,
+             time_budget=None, deferred=False, **kwds):
     """
     Push branches and HEAD forcefully to blackhole `remote`.
 
@@ -474,14 +2354,57 @@ def cli_push(verbose, dry_run, ref_globs, remote, skip_if_no_blackhole,
 
     It is useful to call this command from the ``post-commit`` hook::
 
-      nohup git blackhole push --no-verify &> /dev/null &
+      git blackhole push --background --no-verify
 
-    See also `githooks(5)`.
+    With ``--background``, the push runs in a detached process with
+    low CPU and IO priority and single-threaded pack generation.  Its
+    output is appended to ``--log`` (default:
+    ``$GIT_DIR/blackhole/push.log``) and the command returns
+    immediately.  See also `githooks(5)`.
 
     To push revisions created by git-wip_ command, add option
     ``--ref-glob='refs/wip/*'``.
 
+    By default, ``stash@{N}`` is pushed to ``stash/$HOST/$REPOKEY/N``
+    so that every stash is re-pushed whenever a new stash is created.
+    With ``--stash-key=sha1``, it is pushed to
+    ``stash/$HOST/$REPOKEY/sha1/$SHA1`` instead and the stashes which
+    no longer exist locally are removed from the remote.
+
+    With ``--prune``, branches under ``heads/$HOST/$REPOKEY/`` in the
+    remote are removed when they do not exist locally.  To avoid
+    accidents (e.g., a wrong REPOKEY), nothing is pruned when more
+    than ``--max-prune`` branches would be removed.
+
+    The objects to be sent are estimated against the remote-tracking
+    branches and the refs recorded at the last push.  The estimate is
+    shown with ``--dry-run``.  With ``--max-push-size`` (or config
+    ``blackhole.$REMOTE.maxPushSize``), refs which would send more
+    than the given size are not pushed.  With ``--oversized defer``
+    (default), they are recorded in
+    ``$GIT_DIR/blackhole/deferred-$REMOTE.json`` and pushed later by
+    ``git blackhole push --deferred`` (e.g., from `crontab(5)` at
+    night, or with ``--background``) which pushes only the recorded
+    refs without the size limit.  With ``--oversized skip``, they are
+    not recorded.  Upload bandwidth over SSH can be limited by
+    ``--bwlimit`` (or config ``blackhole.$REMOTE.bwlimit``).
+
+    With ``--time-budget``, HEAD and the current branch are pushed
+    first and the other refs are pushed only within the given time;
+    the rest is deferred to the next push.  This is useful in hooks,
+    combined with the global option ``--timeout`` which kills a push
+    stuck, e.g., by an unresponsive server.
+
+    Cumulative metrics of pushes and trashes per repository (counts,
+    failures, durations, updated refs and estimated bytes) are written
+    to the JSON file at config ``blackhole.statsFile`` and/or the
+    Prometheus textfile at config ``blackhole.promFile`` if set.
+
     """
+    pending = os.environ.pop('GIT_BLACKHOLE_PENDING', None)
+    if pending and os.path.exists(pending):
+        # Let `cli_install_hook` hooks start another push:
+        os.remove(pending)
     if getconfig('remote.{0}.url'.format(remote)) is None:
         if skip_if_no_blackhole:
             return
@@ -489,22 +2412,363 @@ def cli_push(verbose, dry_run, ref_globs, remote, skip_if_no_blackhole,
             print("git blackhole is not configured.")
             print("Run: git blackhole init URL")
             return 1
+    if deferred:
+        result = push_deferred(remote, bwlimit=bwlimit, verbose=verbose,
+                               dry_run=dry_run, **kwds)
+        if not (result['pushed'] or result['code']):
+            print('No deferred ref to push.')
+        return result['code']
+    result = push_refs(remote, ref_globs, stash_key=stash_key, prune=prune,
+                       max_prune=max_prune, max_push_size=max_push_size,
+                       oversized=oversized, bwlimit=bwlimit,
+                       time_budget=time_budget, verbose=verbose,
+                       dry_run=dry_run, **kwds)
+    if result['estimate']:
+        print('Estimated push: {0} objects, {1}'.format(
+            result['estimate'][0], format_size(result['estimate'][1])))
+    if result['unpruned']:
+        print('Not pruning {0} branches (more than --max-prune={1}).'
+              .format(len(result['unpruned']), max_prune))
+    for (spec, size) in result['oversized']:
+        print('{0} {1}: {2} (more than --max-push-size)'.format(
+            'Deferring' if oversized == 'defer' else 'Skipping',
+            spec, format_size(size)))
+    if result['oversized'] and oversized == 'defer' and not dry_run:
+        print('Run "git blackhole push --deferred" to push them.')
+    if result['deferred']:
+        print('Deferring {0} refs (out of --time-budget).'.format(
+            len(result['deferred'])))
+    if not (dry_run or result['code']):
+        schedule_prefetch()
+    return result['code']
+
+
+def push_refs(remote, ref_globs=(), stash_key='index', prune=False,
+              max_prune=20, max_push_size=None, oversized='defer',
+              bwlimit=None, time_budget=None, verbose=False, dry_run=False,
+              **kwds):
+    """
+    Push refs to blackhole `remote` (see `cli_push`).
+
+    Return a dict with keys `code` (exit code of ``git push``),
+    `pushed` (refspecs pushed), `estimate` (``(objects, bytes)`` if
+    `dry_run`), `unpruned` (refspecs not pruned due to `max_prune`),
+    `oversized` (``(refspec, bytes)`` more than `max_push_size`) and
+    `deferred` (refspecs not pushed within `time_budget`).  Oversized
+    refs are recorded for `push_deferred` if `oversized` is
+    ``'defer'``.
+    """
+    import time
     run = make_run(verbose, dry_run, check=False)
-    prefix = getprefix('heads')
-    branches, _checkedout_branches = getbranches()
+    result = dict(code=0, pushed=[], estimate=None, unpruned=[],
+                  oversized=[], deferred=[])
+    info = getrecinfo(remote)
+    metrics = not dry_run and getmetricspaths()
+    began = time.time()
+    counts = dict(push_total=1, push_failures_total=1,
+                  push_refs_updated_total=0, push_bytes_total=0)
+    failed = True
+    try:
+        prefix = getprefix('heads', info=info)
+        branches, _checkedout_branches = getbranches()
+        stashes = [sha1 for (_, _, sha1) in map(parse_stash, git_stash_list())]
+
+        # Build "git push" command options:
+        cmd = cmd_push(remote=remote, force=True, **kwds)
+        cmd.extend(branches)
+        remoterefs = []
+        patterns = []
+        if prune:
+            patterns.append('refs/heads/{0}/*'.format(prefix))
+        if stash_key == 'sha1':
+            patterns.append('refs/heads/{0}/*'.format(
+                getprefix('stash', info=info)))
+        if patterns:
+            remoterefs = [r for (_, r) in ls_remote(run, remote, *patterns)]
+        if prune:
+            stale = refspecs_for_stale_branches(remoterefs, branches,
+                                                info=info)
+            if len(stale) > max_prune:
+                result['unpruned'] = stale
+            else:
+                cmd.extend(stale)
+        if stash_key == 'sha1':
+            cmd.extend(refspecs_for_stash_commits(stashes, info=info))
+            cmd.extend(refspecs_for_stale_stashes(remoterefs, stashes,
+                                                  info=info))
+        else:
+            cmd.extend(refspecs_for_stashes(len(stashes), info=info))
+        cmd.extend(refspecs_from_globs(ref_globs, info=info))
+        # Explicitly specify destination (HEAD:HEAD didn't work):
+        cmd.append('HEAD:refs/heads/{0}/HEAD'.format(prefix))
+
+        nopts = len(cmd_push(remote=remote, force=True, **kwds))
+        plan = plan_push(cmd[nopts:], prefix)
+        del cmd[nopts:]
+        record = load_json(pushrecordpath(remote), {})
+        known = sorted(set(record.values()))
+        revs = [sha1 for (_, _, sha1) in plan if sha1]
+        if max_push_size is None:
+            max_push_size = getconfig(
+                'blackhole.{0}.maxPushSize'.format(remote))
+        max_push_size = max_push_size and parse_size(max_push_size)
+        size = 0
+        if dry_run or max_push_size or metrics:
+            (count, size) = estimate_push(revs, remote, known)
+        if dry_run:
+            result['estimate'] = (count, size)
+        deferred = []
+        if max_push_size and size > max_push_size:
+            for (spec, dst, sha1) in plan:
+                if sha1 and sha1 != record.get(dst):
+                    (_, refsize) = estimate_push([sha1], remote, known)
+                    if refsize > max_push_size:
+                        result['oversized'].append((spec, refsize))
+                        deferred.append((spec, dst, sha1))
+        plan = [p for p in plan if p not in deferred]
+        path = deferredrecordpath(remote)
+        if not dry_run and oversized == 'defer' and deferred:
+            dump_json(path, deferred)
+        elif not dry_run and os.path.exists(path):
+            os.remove(path)
+
+        env = push_env(remote, bwlimit)
+        batches = [plan]
+        if time_budget is not None:
+            try:
+                current = check_output(['git', 'symbolic-ref', '--quiet',
+                                        '--short', 'HEAD']).decode().strip()
+            except CalledProcessError:
+                current = None
+            first = [p for p in plan
+                     if p[0] == current or p[0].startswith('HEAD:')]
+            batches = [first, [p for p in plan if p not in first]]
+
+        start = time.time()
+        code = 0
+        sent = []
+        for (i, batch) in enumerate(batches):
+            if not batch:
+                continue
+            previous = _deadline
+            if time_budget is not None and i > 0:
+                budget = start + time_budget
+                if time.time() >= budget:
+                    result['deferred'] = [
+                        spec for b in batches[i:] for (spec, _, _) in b]
+                    break
+                set_deadline(deadline=min(budget, previous or budget))
+            try:
+                bcode = run(*cmd + [spec for (spec, _, _) in batch], env=env)
+            except BlackholeTimeout as err:
+                if i == 0 or time_budget is None or \
+                        (previous is not None and time.time() >= previous):
+                    raise BlackholeTimeout(
+                        '{0}\nPushed {1} refs; {2} refs are not pushed.'
+                        .format(err, sum(map(len, batches[:i])),
+                                sum(map(len, batches[i:]))))
+                result['deferred'] = [
+                    spec for b in batches[i:] for (spec, _, _) in b]
+                break
+            finally:
+                set_deadline(deadline=previous)
+            if not bcode:
+                result['pushed'].extend(spec for (spec, _, _) in batch)
+                sent.extend(sha1 for (_, _, sha1) in batch if sha1)
+            if not (dry_run or bcode):
+                counts['push_refs_updated_total'] += \
+                    count_updated_refs(record, batch)
+                update_push_record(remote, batch)
+            code = code or bcode
+        if metrics and sent:
+            # Exclude objects of the refs deferred or failed to be pushed:
+            unsent = [sha1 for sha1 in revs if sha1 not in sent]
+            counts['push_bytes_total'] = size
+            if unsent:
+                counts['push_bytes_total'] -= estimate_push(
+                    unsent, remote, known + sent)[1]
+        result['code'] = code
+        failed = bool(code)
+        return result
+    finally:
+        # Record failures including timeouts and errors of git commands:
+        if metrics:
+            counts['push_failures_total'] = int(failed)
+            update_metrics(info['repo'], counts,
+                           duration=time.time() - began,
+                           success=not counts['push_failures_total'])
+
+
+def deferredrecordpath(remote):
+    return getgitpath('blackhole/deferred-{0}.json'.format(remote))
+
+
+def push_env(remote, bwlimit=None):
+    """
+    Return the environment for ``git push`` limited by `bwlimit`.
+
+    `bwlimit` defaults to config ``blackhole.$REMOTE.bwlimit``.
+    `None` is returned if there is no limit.
+    """
+    if bwlimit is None:
+        bwlimit = getconfig('blackhole.{0}.bwlimit'.format(remote))
+    if bwlimit:
+        return dict(os.environ,
+                    GIT_SSH_COMMAND=throttled_ssh_command(parse_size(bwlimit)))
+
 
-    # Build "git push" command options:
+def push_deferred(remote, bwlimit=None, verbose=False, dry_run=False,
+                  **kwds):
+    """
+    Push refs deferred by `push_refs` due to `max_push_size`.
+
+    The recorded commits are pushed as they were when deferred.  Return
+    a dict as `push_refs` does.
+    """
+    run = make_run(verbose, dry_run, check=False)
+    result = dict(code=0, pushed=[], estimate=None, unpruned=[],
+                  oversized=[], deferred=[])
+    path = deferredrecordpath(remote)
+    plan = [tuple(p) for p in load_json(path, [])]
+    if not plan:
+        return result
+    specs = ['{0}:{1}'.format(sha1, dst) for (_, dst, sha1) in plan]
     cmd = cmd_push(remote=remote, force=True, **kwds)
-    cmd.extend(branches)
-    cmd.extend(refspecs_for_stashes(len(git_stash_list())))
-    cmd.extend(refspecs_from_globs(ref_globs))
-    # Explicitly specify destination (HEAD:HEAD didn't work):
-    cmd.append('HEAD:refs/heads/{0}/HEAD'.format(prefix))
+    result['code'] = run(*cmd + specs, env=push_env(remote, bwlimit))
+    if not (dry_run or result['code']):
+        result['pushed'] = specs
+        update_push_record(remote, plan)
+        os.remove(path)
+    return result
+
+
+def cli_status(remote, ref_globs, stash_key, quiet, verbose, dry_run):
+    """
+    Show refs which are not pushed to blackhole `remote` yet.
+
+    Branches, stashes, refs matching ``--ref-glob`` and HEAD (i.e.,
+    what ``git blackhole push`` would push) are compared with the
+    remote-tracking branches of `remote` and the refs recorded at the
+    last ``git blackhole push``.  For each ref not pushed, the number
+    of commits not in the blackhole is shown.  This command does not
+    access the network so that the result may be outdated if the
+    blackhole is updated from elsewhere.
+
+    Exit with code 1 when some refs are not pushed and with code 2 when
+    git blackhole is not configured.  Nothing is printed with
+    ``--quiet``, which is useful for a shell prompt::
+
+      git blackhole status --quiet || echo '(not backed up)'
+
+    """
+    if getconfig('remote.{0}.url'.format(remote)) is None:
+        if not quiet:
+            print("git blackhole is not configured.")
+        return 2
+    unpushed = getunpushed(remote, ref_globs, stash_key)
+    if not unpushed:
+        return
+    if not quiet:
+        for ref in unpushed:
+            print('{0}: {1} commit(s) not pushed'.format(
+                ref['ref'], ref['commits']))
+    return 1
+
+
+def getunpushed(remote, ref_globs=(), stash_key='index', info=None):
+    """
+    Return a list of refs not pushed to `remote` yet.
+
+    See ``git blackhole status``.  Each ref is a dict with keys `ref`
+    (local name), `dst` (remote ref), `sha1` and `commits` (the number
+    of commits not in `remote`).
 
-    return run(*cmd)
+    """
+    info = info or getrecinfo(remote)
+    prefix = getprefix('heads', info=info)
+    branches, _checkedout_branches = getbranches()
+    stashes = [sha1 for (_, _, sha1) in map(parse_stash, git_stash_list())]
+    refspecs = list(branches)
+    if stash_key == 'sha1':
+        refspecs.extend(refspecs_for_stash_commits(stashes, info=info))
+    else:
+        refspecs.extend(refspecs_for_stashes(len(stashes), info=info))
+    refspecs.extend(refspecs_from_globs(ref_globs, info=info))
+    refspecs.append('HEAD:refs/heads/{0}/HEAD'.format(prefix))
+    plan = [p for p in plan_push(refspecs, prefix) if p[2]]
+
+    pushed = load_json(pushrecordpath(remote), {})
+    out = check_output(['git', 'for-each-ref',
+                        '--format=%(objectname) %(refname)',
+                        'refs/remotes/{0}/'.format(remote)])
+    tracking = 'refs/remotes/{0}/'.format(remote)
+    for line in out.decode().splitlines():
+        (sha1, ref) = line.split(' ', 1)
+        pushed.setdefault(
+            'refs/heads/{0}/{1}'.format(prefix, ref[len(tracking):]), sha1)
+    plan = [p for p in plan if pushed.get(p[1]) != p[2]]
+    if not plan:
+        return []
+    counts = count_unpushed([sha1 for (_, _, sha1) in plan], remote,
+                            sorted(set(pushed.values())))
+    return [dict(ref=spec.split(':', 1)[0], dst=dst, sha1=sha1,
+                 commits=count)
+            for ((spec, dst, sha1), count) in zip(plan, counts)]
+
+
+MAINTENANCE_STEPS = [
+    ('pack-refs', ['pack-refs', '--all', '--prune']),
+    ('repack', ['repack', '-d', '-l', '--geometric=2']),
+    ('commit-graph', ['commit-graph', 'write', '--reachable', '--split']),
+    ('multi-pack-index', ['multi-pack-index', 'write']),
+]
+
+
+def local_remote_path(remote):
+    """
+    Return the path of `remote` if its URL is a local path.
+    """
+    import re
+    url = getconfig('remote.{0}.url'.format(remote))
+    if url is None:
+        raise BlackholeError(
+            'Remote {0} is not configured.'.format(remote))
+    if url.startswith('file://'):
+        url = url[len('file://'):]
+    elif '://' in url or re.match(r'[^/]+:', url):
+        raise BlackholeError(
+            'Remote {0} is not a local repository: {1}'.format(remote, url))
+    return os.path.join(getrepopath()[0], os.path.expanduser(url))
+
+
+def cli_maintain(path, remote, verbose, dry_run):
+    """
+    Optimize a local (or mounted) blackhole repository.
 
+    Refs are packed, objects are repacked incrementally (geometric
+    repack, i.e., only small packs are merged), and the commit-graph
+    and the multi-pack-index are updated.  The time taken by each step
+    is reported.  The blackhole repository at `path` (default: the URL
+    of ``--remote``) must be accessible as a local path.
 
-def cli_trash_branch(branches, verbose, dry_run, **kwds):
+    """
+    import time
+    run = make_run(verbose, dry_run)
+    if path is None:
+        path = local_remote_path(remote)
+    try:
+        check_output(['git', '--git-dir=' + path, 'rev-parse', '--git-dir'])
+    except CalledProcessError:
+        raise BlackholeError('Not a git repository: {0}'.format(path))
+    for (name, args) in MAINTENANCE_STEPS:
+        start = time.time()
+        run('git', '--git-dir=' + path, *args)
+        if not dry_run:
+            print('{0}: {1:.2f}s'.format(name, time.time() - start))
+
+
+def cli_trash_branch(branches, remote, remove_upstream, verbose, dry_run,
+                     **kwds):
     """
     [EXPERIMENTAL] Save `branch` in blackhole `remote` before deletion.
 
@@ -516,6 +2780,10 @@ def cli_trash_branch(branches, verbose, dry_run, **kwds):
     commit recording the revision of `branch` and some meta
     information).
 
+    A branch is not pushed again if its commit is already trashed under
+    the same name from this repository (or fetched by ``git blackhole
+    fetch-trash``); it is just removed.
+
     Use ``git blackhole fetch-trash`` to retrieve all trashes from
     remote and store them locally.  Commands ``git blackhole
     ls-branch`` and ``git blackhole show-branch`` can be used to list
@@ -533,40 +2801,132 @@ def cli_trash_branch(branches, verbose, dry_run, **kwds):
       branch named ``trash/$REV[:2]/$REV[2:]``, since the JSON has all
       the info I need.
     """
-    run = make_run(verbose, dry_run)
     _branches, checkedout_branches = getbranches()
     final_code = None
+    trashes = []
     for branch in branches:
-        code = trash_branch(
-            run, checkedout_branches, branch, verbose=verbose, dry_run=dry_run, **kwds
-        )
-        if code:
-            final_code = code
+        if branch in checkedout_branches:
+            print("Cannot trash the branch '{0}' which you are currently on."
+                  .format(branch))
+            final_code = 1
+        else:
+            trashes.append(branch)
+    if not trashes:
+        return final_code
+
+    results = trash_branches(trashes, remote, remove_upstream,
+                             verbose, dry_run, **kwds)
+    for trash in results:
+        if not trash['pushed']:
+            print('{0} is already trashed.'.format(trash['branch']))
+    for trash in results:
+        if remove_upstream and trash['upstream'] is None:
+            print('Not removing upstream branch of {0} as upstream is'
+                  ' not configured.'.format(trash['branch']))
     return final_code
 
 
-def trash_branch(
-    run, checkedout_branches, branch, verbose, dry_run, remote, remove_upstream, **kwds
-):
-    if branch in checkedout_branches:
-        print("Cannot trash the branch '{0}' which you are currently on."
-              .format(branch))
-        return 1
-    if remove_upstream:
-        upstream_repo = getconfig('branch.{0}.remote'.format(branch))
-        upstream_branch = getconfig('branch.{0}.merge'.format(branch))
-    trash_commitish(
-        branch, remote, dict(command='trash-branch', branch=branch),
-        'Trash branch "{branch}" at {host}:{repo}',
-        verbose, dry_run, **kwds)
-    run('git', 'branch', '--delete', '--force', branch)
+def trash_branches(branches, remote, remove_upstream, verbose, dry_run,
+                   **kwds):
+    """
+    Trash `branches` and delete them locally.
+
+    Return the list of trashes (see `trash_commitishes`).  With
+    `remove_upstream`, each trash has key `upstream`; the upstream
+    branch ``(remote, ref)`` removed or `None` if not configured.
+    """
+    run = make_run(verbose, dry_run)
+    _branches, checkedout_branches = getbranches()
+    for branch in branches:
+        if branch in checkedout_branches:
+            raise BlackholeError(
+                'Cannot trash the branch {0} which is checked out.'
+                .format(branch))
 
+    upstreams = {}
     if remove_upstream:
-        if upstream_repo is None:
-            print('Not removing upstream branch as upstream is'
-                  ' not configured.')
-        else:
-            run('git', 'push', upstream_repo, ':' + upstream_branch)
+        for branch in branches:
+            upstream_repo = getconfig('branch.{0}.remote'.format(branch))
+            upstream_branch = getconfig('branch.{0}.merge'.format(branch))
+            upstreams[branch] = upstream_repo and \
+                (upstream_repo, upstream_branch)
+
+    results = trash_commitishes(
+        [(branch, dict(command='trash-branch', branch=branch),
+          'Trash branch "{branch}" at {host}:{repo}')
+         for branch in branches],
+        remote, verbose, dry_run, **kwds)
+    run('git', 'branch', '--delete', '--force', *branches)
+    refspecs = {}
+    for (upstream_repo, upstream_branch) in filter(None, upstreams.values()):
+        refspecs.setdefault(upstream_repo, []).append(':' + upstream_branch)
+    for (upstream_repo, specs) in sorted(refspecs.items()):
+        run('git', 'push', upstream_repo, *specs)
+    if remove_upstream:
+        for trash in results:
+            trash['upstream'] = upstreams[trash['branch']]
+    return results
+
+
+def select_stale_branches(merged_into=None, older_than=None, patterns=()):
+    """
+    Select local branches by merge status, age and name patterns.
+
+    Merge status and committer dates of all branches are read by a
+    single ``git for-each-ref``.  `older_than` is in days.
+    """
+    import fnmatch
+    import time
+    cmd = ['git', 'for-each-ref',
+           '--format=%(refname:short) %(committerdate:unix)']
+    if merged_into:
+        cmd.append('--merged=' + merged_into)
+    cmd.append('refs/heads/')
+    out = check_output(cmd).decode()
+    cutoff = time.time() - (older_than or 0) * 24 * 60 * 60
+    selected = []
+    for line in out.splitlines():
+        (branch, date) = line.rsplit(' ', 1)
+        if branch == merged_into:
+            continue
+        if older_than is not None and int(date) >= cutoff:
+            continue
+        if patterns and not any(fnmatch.fnmatchcase(branch, p)
+                                for p in patterns):
+            continue
+        selected.append(branch)
+    return selected
+
+
+def cli_auto_trash(merged_into, older_than, patterns, remote,
+                   remove_upstream, verbose, dry_run, **kwds):
+    """
+    [EXPERIMENTAL] Trash stale branches selected by rules.
+
+    Branches merged into ``--merged-into``, whose last commit is older
+    than ``--older-than`` days and whose names match ``--pattern`` are
+    selected (rules not given are ignored) and then trashed as in
+    ``git blackhole trash-branch``.  The branch given to
+    ``--merged-into`` and the branches checked out are never trashed.
+    Use ``--dry-run`` to see which branches are selected.
+
+    """
+    if not (merged_into or older_than is not None or patterns):
+        raise BlackholeError(
+            'Specify at least one of --merged-into, --older-than and'
+            ' --pattern.')
+    _branches, checkedout_branches = getbranches()
+    branches = [b for b in select_stale_branches(merged_into, older_than,
+                                                 patterns)
+                if b not in checkedout_branches]
+    if not branches:
+        print('No branch to trash.')
+        return
+    print('Trashing branches:', *branches)
+    if dry_run:
+        return
+    return cli_trash_branch(branches, remote, remove_upstream,
+                            verbose, dry_run, **kwds)
 
 
 def cli_trash_stash(remote, stash_range, keep_stashes,
@@ -584,51 +2944,227 @@ def cli_trash_stash(remote, stash_range, keep_stashes,
     stashes 0 to 10, ``git blackhole trash-stash 0,3-5,8-`` removes
     stashes 0, 3, 4, 5, 8, 9, and 10.
 
+    """
+    results = trash_stashes(remote, stash_range, keep_stashes,
+                            verbose, dry_run, **kwds)
+    if not results:
+        print('No stash is found.')
+    for trash in results:
+        if not trash['pushed']:
+            print('{0} is already trashed.'.format(trash['rev']))
+
+
+def trash_stashes(remote, stash_range, keep_stashes, verbose, dry_run,
+                  **kwds):
+    """
+    Trash stashes in `stash_range` and drop them unless `keep_stashes`.
+
+    Return the list of trashes (see `trash_commitishes`).
     """
     run = make_run(verbose, dry_run)
     in_range = parse_range(stash_range)
     stashes = [s for s in map(parse_stash, git_stash_list())
                if in_range(s[0])]
-
     if not stashes:
-        print('No stash is found.')
-        return
+        return []
+
+    results = trash_commitishes(
+        [(sha1, dict(command='trash-stash'), 'Trash a stash at {host}:{repo}')
+         for (num, raw, sha1) in stashes],
+        remote, verbose, dry_run, **kwds)
+    if not keep_stashes:
+        # Using "git stash drop stash@{SHA1}" is unreliable because
+        # sometime git confuses SHA1 with date (e.g., SHA1 could starts
+        # with "1d").  So "stash@{N}" must be used.  However, "N" would
+        # change if newer stashes are popped.  Hence `reversed`.
+        for (num, raw, sha1) in reversed(stashes):
+            run('git', 'stash', 'drop', 'stash@{{{0}}}'.format(num))
+    return results
+
+
+def refspec_for_trash_fetch(ref):
+    """
+    Compile a refspec to fetch trash `ref` to ``refs/bh/trash/``.
+
+    >>> refspec_for_trash_fetch('refs/heads/trash/myhost/repo/01/2345')
+    'refs/heads/trash/myhost/repo/01/2345:refs/bh/trash/01/2345'
+
+    """
+    return '{0}:refs/bh/trash/{1[0]}/{1[1]}'.format(
+        ref, ref.rsplit('/', 2)[-2:])
 
-    # Using "git stash drop stash@{SHA1}" is unreliable because
-    # sometime git confuses SHA1 with date (e.g., SHA1 could starts
-    # with "1d").  So "stash@{N}" must be used.  However, "N" would
-    # change if newer stashes are popped.  Hence `reversed`.
-    for (num, raw, sha1) in reversed(stashes):
-        if in_range(num):
-            stash = 'stash@{{{0}}}'.format(num)
-            trash_commitish(
-                sha1, remote, dict(command='trash-stash'),
-                'Trash a stash at {host}:{repo}',
-                verbose, dry_run, **kwds)
-            if not keep_stashes:
-                run('git', 'stash', 'drop', stash)
 
+def cli_compact(remote, host, older_than, period, verbose, dry_run):
+    """
+    [EXPERIMENTAL] Fold old trashes into archive commits.
+
+    Trashes of this repository at `host` older than ``--older-than``
+    days are grouped by ``--period`` (month or year of the trash
+    commit).  Trashes in each group are folded into an archive commit
+    whose parents are the trash commits.  The archive is pushed as a
+    trash branch and then the trash branches folded into it are
+    removed from the remote.  This reduces the number of refs in the
+    blackhole while keeping all trashes reachable.
+
+    Archives are recognized by ``git blackhole ls-trash`` and ``git
+    blackhole show-trash``; the trashes in them are listed as usual.
+    Trashes fetched locally by ``git blackhole fetch-trash`` are
+    replaced with the archives as well.
+
+    """
+    import re
+    import time
+    run = make_run(verbose, dry_run)
+    info = getrecinfo(remote)
+    if host:
+        info['host'] = host
+    prefix = 'refs/heads/' + getprefix('trash', info) + '/'
+    istrash = re.compile(r'[0-9a-f]{2}/[0-9a-f]{38}\Z').match
+    refs = [(sha1, r) for (sha1, r) in ls_remote(run, remote, prefix + '*')
+            if r.startswith(prefix) and istrash(r[len(prefix):])]
+    run('git', 'fetch', remote, '--stdin',
+        input=''.join(refspec_for_trash_fetch(r) + '\n' for (_, r) in refs))
+    commits = read_commits(sorted(set(sha1 for (sha1, _) in refs)))
+
+    fmt = {'month': '%Y-%m', 'year': '%Y'}[period]
+    cutoff = time.time() - older_than * 24 * 60 * 60
+    groups = {}
+    for (sha1, r) in refs:
+        commit = commits.get(sha1)
+        # Archives (having multiple parents) are not folded again:
+        if commit and len(commit['parents']) == 1 and \
+                commit['time'] < cutoff:
+            key = time.strftime(fmt, time.gmtime(commit['time']))
+            groups.setdefault(key, []).append((sha1, r))
+    groups = sorted((k, v) for (k, v) in groups.items() if len(v) > 1)
+    if not groups:
+        print('No trash to compact.')
+        return
 
-def cli_fetch_trash(remote, verbose, dry_run):
+    tree = check_communicate(['git', 'mktree'], '').decode().strip()
+    archives = []
+    for (key, trashes) in groups:
+        obj = dict(info, command='compact', period=key, count=len(trashes))
+        heading = 'Archive {count} trashes of {period} at {host}:{repo}' \
+            .format(**obj)
+        rev = git_mkcommit(tree, [sha1 for (sha1, _) in trashes],
+                           format_json_message(heading, obj))
+        archives.append(rev)
+        print(heading)
+
+    # Push archives first so that nothing is lost when removing trashes
+    # fails in the middle:
+    run(*cmd_push(remote) + ['{0}:{1}{2}/{3}'.format(rev, prefix, rev[:2],
+                                                      rev[2:])
+                             for rev in archives])
+    folded = [r for (_, trashes) in groups for (_, r) in trashes]
+    chunk = 1000
+    for i in range(0, len(folded), chunk):
+        run(*cmd_push(remote) + [':' + r for r in folded[i:i + chunk]])
+
+    localrefs = ['refs/bh/trash/{0}/{1}'.format(rev[:2], rev[2:])
+                 for rev in archives]
+    run('git', 'update-ref', '--stdin', input=''.join(
+        ['create {0} {1}\n'.format(r, rev)
+         for (r, rev) in zip(localrefs, archives)] +
+        ['delete {0}\n'.format(refspec_for_trash_fetch(r).split(':')[1])
+         for r in folded]))
+
+
+def cli_fetch_trash(remote, verbose, dry_run, metadata_only=False):
     """
     Fetch trashes from remote to ``refs/bh/trash/``.
+
+    Fetched trashes are recorded so that ``git blackhole trash-branch``
+    and ``git blackhole trash-stash`` do not trash the same commit (of
+    the same branch name) again.
+
+    With ``--metadata-only``, only commits are fetched (``--filter
+    tree:0``), which is enough for ``git blackhole ls-trash`` and
+    ``git blackhole find-trash``.  The blackhole `remote` is configured
+    as a promisor remote so that trees and blobs are fetched on demand,
+    e.g., by ``git blackhole show-trash``.  The blackhole repository
+    has to allow it by setting ``uploadpack.allowFilter``.
     """
     run = make_run(verbose, dry_run)
+    if metadata_only:
+        run('git', 'config', 'remote.{0}.promisor'.format(remote), 'true')
     info = dict(getrecinfo(), host='*')
     prefix = getprefix('trash', info)
-    out = run('git', 'ls-remote', 'blackhole',
+    out = run('git', 'ls-remote', remote,
               'refs/heads/' + prefix + '/*', out=True)
     refs = [l.split(None, 1)[1] for l in out.decode().splitlines()]
     cmd = ['git', 'fetch']
     if verbose:
         cmd.append('--verbose')
+    if metadata_only:
+        cmd.append('--filter=tree:0')
     cmd.append(remote)
     cmd.append('--')
-    cmd.extend(
-        '{0}:refs/bh/trash/{1[0]}/{1[1]}'.format(r, r.rsplit('/', 2)[-2:])
-        for r in refs
-    )
+    cmd.extend(map(refspec_for_trash_fetch, refs))
     run(*cmd)
+    update_trash_index(run)
+    if not dry_run:
+        update_trash_record(getconfig('remote.{0}.url'.format(remote)),
+                            gettrashes())
+
+
+def update_trash_index(run):
+    """
+    Add commits reachable from local trashes to the commit-graph.
+
+    The commit-graph stores generation numbers which make containment
+    queries by ``git for-each-ref --contains`` (used by ``git blackhole
+    find-trash``) fast.  It is updated incrementally by writing a new
+    layer of a split commit-graph.
+
+    """
+    out = check_output(['git', 'for-each-ref', '--format=%(objectname)',
+                        'refs/bh/trash/'])
+    if out:
+        run('git', 'commit-graph', 'write', '--split', '--stdin-commits',
+            input=out.decode())
+
+
+def find_trashes(commit):
+    """
+    Return a list of local trashes containing `commit`.
+    """
+    try:
+        commit = check_output(['git', 'rev-parse', '--verify', '--quiet',
+                               commit + '^{commit}']).decode().strip()
+    except CalledProcessError:
+        raise BlackholeError('Not a valid commit: {0}'.format(commit))
+    out = check_output(['git', 'for-each-ref', '--format=%(objectname)',
+                        '--contains=' + commit, 'refs/bh/trash/'])
+    revs = out.decode().split()
+    if not revs:
+        return []
+    # The trashes containing `commit` (including those in archives
+    # made by `git blackhole compact`) are on the ancestry path from
+    # `commit` to the matched refs:
+    out = check_communicate(
+        ['git', 'rev-list', '--ancestry-path', '--stdin'],
+        ''.join(r + '\n' for r in ['^' + commit] + revs))
+    path = set(out.decode().split())
+    path.add(commit)
+    return gettrashes(revs=revs, within=path)
+
+
+def cli_find_trash(commit, verbose, dry_run):
+    """
+    List local trashes containing `commit`.
+
+    Trashes fetched by ``git blackhole fetch-trash`` are searched.  The
+    search uses the commit-graph updated by ``git blackhole
+    fetch-trash`` so that it is fast even with many trashes.  Exit with
+    code 1 if no trash contains `commit`.
+
+    """
+    trashes = find_trashes(commit)
+    show_trashes(trashes, verbose)
+    if not trashes:
+        return 1
 
 
 def cli_ls_trash(verbose, dry_run):
@@ -647,6 +3183,161 @@ def cli_show_trash(verbose, dry_run):
     run('git', 'show', *revs)
 
 
+def parse_date(date):
+    """
+    Convert `date` in any format git understands to a UNIX time.
+    """
+    out = check_output(['git', 'rev-parse', '--since=' + date])
+    return int(out.decode().strip().split('=', 1)[1])
+
+
+def select_trashes(trashes, all, branches, host, since, until):
+    """
+    Select `trashes` by branch name patterns, host and time range.
+
+    Trashes must have key ``time``.  Everything is selected if `all`
+    is true; otherwise at least one criterion has to be given.
+
+    >>> trashes = [dict(branch='a', host='x', time=10),
+    ...            dict(branch='b', host='y', time=20),
+    ...            dict(host='x', time=30)]
+    >>> select_trashes(trashes, False, ['a', 'c*'], None, None, None)
+    [{'branch': 'a', 'host': 'x', 'time': 10}]
+    >>> len(select_trashes(trashes, False, [], 'x', None, None))
+    2
+    >>> select_trashes(trashes, False, [], None, 15, 25)[0]['branch']
+    'b'
+
+    """
+    import fnmatch
+    if not (all or branches or host or since or until):
+        raise BlackholeError(
+            'Specify trashes to restore by --branch, --host, --since,'
+            ' --until or --all.')
+    return [
+        t for t in trashes
+        if (not branches or any(fnmatch.fnmatchcase(t.get('branch', ''), b)
+                                for b in branches)) and
+        (not host or t.get('host') == host) and
+        (not since or t['time'] >= since) and
+        (not until or t['time'] <= until)]
+
+
+def cli_restore_trash(all, branches, host, since, until, on_conflict,
+                      verbose, dry_run):
+    """
+    [EXPERIMENTAL] Recreate branches and stashes from trashes.
+
+    Trashes fetched by ``git blackhole fetch-trash`` are selected by
+    branch name (``--branch``, glob patterns allowed), the host where
+    they were trashed (``--host``) and the time of trashing
+    (``--since`` and ``--until``, in any format git understands).  Use
+    ``--all`` to restore everything.
+
+    Branches are recreated with their original names in a single
+    ``git update-ref --stdin`` transaction.  When a branch with the
+    same name already exists (or several selected trashes have the
+    same name, in which case the newest one takes the name), it is
+    skipped (``--on-conflict=skip``), restored as
+    ``<branch>-trash-<SHA1>`` (``--on-conflict=rename``; a number is
+    appended if that name is taken as well) or overwritten
+    (``--on-conflict=force``).  The branch currently checked out is
+    never overwritten.  Stashes are put back in the stash list by ``git
+    stash store``.
+
+    """
+    for trash in restore_trashes(all, branches, host, since, until,
+                                 on_conflict, verbose, dry_run):
+        if trash.get('command') != 'trash-branch':
+            print('Restoring stash {0}'.format(trash['rev']))
+        elif trash['restored']:
+            print('Restoring branch {0} at {1}'.format(
+                trash['ref'][len('refs/heads/'):], trash['rev']))
+        elif trash['ref']:
+            print('Branch {0} is already at {1}.'.format(
+                trash['ref'][len('refs/heads/'):], trash['rev']))
+        else:
+            print('Not restoring {0} at {1} (branch exists).'.format(
+                trash['branch'], trash['rev']))
+
+
+def restore_trashes(all, branches, host, since, until, on_conflict,
+                    verbose, dry_run):
+    """
+    Restore selected trashes (see `cli_restore_trash`).
+
+    Return the list of the selected trashes.  For branches, key `ref`
+    is the branch restored or already at the trashed commit (`None` if
+    skipped due to a conflict) and key `restored` is true if it is
+    created or updated.  Stashes already in the stash list are omitted.
+    """
+    import itertools
+    run = make_run(verbose, dry_run)
+    trashes = gettrashes()
+    commits = read_commits([t['rev_info'] for t in trashes])
+    for trash in trashes:
+        trash['time'] = commits[trash['rev_info']]['time']
+    trashes = select_trashes(
+        trashes, all, branches, host,
+        since and parse_date(since), until and parse_date(until))
+    trashes.sort(key=lambda t: t['time'], reverse=True)
+
+    existing = dict(
+        line.split() for line in check_output(
+            ['git', 'for-each-ref', '--format=%(refname) %(objectname)',
+             'refs/heads/']).decode().splitlines())
+    stashes = set(sha1 for (_, _, sha1) in map(parse_stash, git_stash_list()))
+    commands = []
+    restored = []
+    results = []
+    _branches, checkedout_branches = getbranches()
+    for trash in trashes:
+        if trash.get('command') != 'trash-branch':
+            continue
+        results.append(trash)
+        trash.update(ref=None, restored=False)
+        branch = trash['branch']
+        ref = 'refs/heads/' + branch
+        if existing.get(ref) == trash['rev']:
+            trash['ref'] = ref
+            continue
+        if ref not in existing:
+            commands.append('create {0} {1}\n'.format(ref, trash['rev']))
+        elif on_conflict == 'rename':
+            base = branch + '-trash-' + trash['rev_info'][:7]
+            branch = base
+            for i in itertools.count(2):
+                ref = 'refs/heads/' + branch
+                if existing.get(ref) in (None, trash['rev']):
+                    break
+                branch = '{0}-{1}'.format(base, i)
+            trash['ref'] = ref
+            if ref in existing:
+                continue
+            commands.append('create {0} {1}\n'.format(ref, trash['rev']))
+        elif on_conflict == 'skip' or ref in restored or \
+                branch in checkedout_branches:
+            continue
+        else:
+            commands.append('update {0} {1} {2}\n'.format(
+                ref, trash['rev'], existing[ref]))
+        existing[ref] = trash['rev']
+        restored.append(ref)
+        trash.update(ref=ref, restored=True)
+    if commands:
+        run('git', 'update-ref', '--stdin', input=''.join(commands))
+
+    # Store older stashes first so that the newest one becomes stash@{0}:
+    for trash in reversed(trashes):
+        if trash.get('command') == 'trash-stash' and \
+                trash['rev'] not in stashes:
+            stashes.add(trash['rev'])
+            results.append(trash)
+            run('git', 'stash', 'store', '--message', trash['heading'],
+                trash['rev'])
+    return results
+
+
 def cli_rm_local_trash(verbose, dry_run, refs, all):
     """
     Remove trashes fetched by ``git blackhole fetch-trash``.
@@ -660,6 +3351,168 @@ def cli_rm_local_trash(verbose, dry_run, refs, all):
         run('git', 'update-ref', '-d', r)
 
 
+def _in_repo(method):
+    """
+    Run `method` of `Blackhole` in its repository.
+    """
+    import functools
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwds):
+        cwd = os.getcwd()
+        os.chdir(self.repo)
+        try:
+            return method(self, *args, **kwds)
+        except CalledProcessError as err:
+            raise GitCommandError(err)
+        finally:
+            os.chdir(cwd)
+    return wrapper
+
+
+class Blackhole(object):
+
+    """
+    Library interface to git blackhole for repository `repo`.
+
+    Unlike ``cli_*`` functions which print results and return exit
+    codes, methods of this class return results as Python objects and
+    raise `BlackholeError` or its subclasses (`NotConfigured`,
+    `GitCommandError`, `BlackholeTimeout`) on failure.  The record
+    information (host, repository path and REPOKEY) is resolved once
+    and the object reader for trashes is kept open so that a session
+    can be used for many operations::
+
+      with Blackhole('path/to/repo') as bh:
+          bh.push()
+          for trash in bh.fetch_trashes():
+              print(trash['rev'], trash.get('branch'))
+
+    Methods change the current directory to `repo` while running.
+    Hence a session must not be used from multiple threads.
+
+    """
+
+    def __init__(self, repo='.', remote='blackhole'):
+        self.repo = os.path.abspath(repo)
+        self.remote = remote
+        self._info = None
+        self._reader = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._reader:
+            self._reader.close()
+        self._reader = None
+
+    @property
+    @_in_repo
+    def info(self):
+        """
+        Record information of the repository (see `getrecinfo`).
+        """
+        self._check_configured()
+        return dict(self._info)
+
+    def _check_configured(self):
+        if self._info is None:
+            if getconfig('remote.{0}.url'.format(self.remote)) is None:
+                raise NotConfigured(
+                    'Remote {0} is not configured.  Run: git blackhole init'
+                    .format(self.remote))
+            self._info = getrecinfo(self.remote)
+
+    @_in_repo
+    def status(self, ref_globs=(), stash_key='index'):
+        """
+        Return a list of refs not pushed yet (see `getunpushed`).
+        """
+        return getunpushed(self.remote, ref_globs, stash_key,
+                           info=self.info)
+
+    @_in_repo
+    def push(self, ref_globs=(), **options):
+        """
+        Push as ``git blackhole push`` and return `status` afterwards.
+
+        `options` are the keyword arguments of `push_refs`.  A non-empty
+        list is returned if some refs are deferred.
+        """
+        self._check_configured()
+        result = push_refs(self.remote, list(ref_globs), **options)
+        if result['code']:
+            raise GitCommandError(
+                CalledProcessError(result['code'], 'git push'))
+        return self.status(ref_globs, options.get('stash_key', 'index'))
+
+    @_in_repo
+    def trash_branches(self, branches, remove_upstream=False, **options):
+        """
+        Trash `branches` as ``git blackhole trash-branch``.
+
+        Return the list of trashes (see `trash_branches`).
+        """
+        self._check_configured()
+        return trash_branches(list(branches), self.remote, remove_upstream,
+                              verbose=False, dry_run=False, **options)
+
+    @_in_repo
+    def trash_stashes(self, stash_range, keep_stashes=False, **options):
+        """
+        Trash stashes as ``git blackhole trash-stash``.
+
+        Return the list of trashes (see `trash_stashes`).
+        """
+        self._check_configured()
+        return trash_stashes(self.remote, stash_range, keep_stashes,
+                             verbose=False, dry_run=False, **options)
+
+    @_in_repo
+    def fetch_trashes(self):
+        """
+        Fetch trashes as ``git blackhole fetch-trash`` and return them.
+        """
+        self._check_configured()
+        cli_fetch_trash(self.remote, verbose=False, dry_run=False)
+        return self.trashes()
+
+    @_in_repo
+    def trashes(self):
+        """
+        Return a list of local trashes (see `gettrashes`).
+        """
+        if self._reader is None:
+            try:
+                self._reader = ObjectReader()
+            except UnsupportedRepository:
+                return gettrashes()
+        return gettrashes(self._reader)
+
+    @_in_repo
+    def find_trashes(self, commit):
+        """
+        Return a list of local trashes containing `commit`.
+        """
+        return find_trashes(commit)
+
+    @_in_repo
+    def restore_trashes(self, all=False, branches=(), host=None,
+                        since=None, until=None, on_conflict='skip'):
+        """
+        Restore trashes as ``git blackhole restore-trash``.
+
+        Return the list of restored or skipped trashes (see
+        `restore_trashes`).
+        """
+        return restore_trashes(all, list(branches), host, since, until,
+                               on_conflict, verbose=False, dry_run=False)
+
+
 def make_parser(doc=__doc__):
     import argparse
 
@@ -674,6 +3527,12 @@ def make_parser(doc=__doc__):
         '--version', action='version',
         version='%(prog)s {} from {}'.format(__version__, __file__))
     parser.add_argument('--debug', default=False, action='store_true')
+    parser.add_argument('--timeout', type=float, metavar='SECONDS',
+                        help='kill git commands still running SECONDS'
+                        ' after start (of each push for watch) and fail.'
+                        '  0 means no timeout.'
+                        ' Default to blackhole.timeout config for'
+                        ' commands talking to remotes.')
     subparsers = parser.add_subparsers()
 
     def subp(command, func):
@@ -734,10 +3593,45 @@ def make_parser(doc=__doc__):
     p.add_argument('--repokey',
                    help='The repository relative to the $HOME at <HOST>.'
                    ' Use current repository root if empty.')
+    p.add_argument('--branch', action='append', default=[], dest='branches',
+                   help='fetch only this branch (or HEAD).'
+                   ' Can be given multiple times.')
+    p.add_argument('--filter', nargs='?', const='blob:none', metavar='SPEC',
+                   help='fetch lazily with partial clone filter SPEC'
+                   ' (default: blob:none)')
+    p.add_argument('--prefetch', action='store_true',
+                   help='prefetch in background (see: git blackhole'
+                   ' prefetch)')
     p.add_argument('host', default='', metavar='HOST', nargs='?',
                    help='The host name of the repository.'
                    ' Use current host name if empty.')
 
+    for (command, func) in [('export', cli_export), ('import', cli_import)]:
+        p = subp(command, func)
+        p.add_argument('--remote', default='blackhole',
+                       help='name of the remote blackhole repository')
+        p.add_argument('--host', default='',
+                       help='host name in the blackhole.'
+                       ' Use current host name if empty.')
+        p.add_argument('--repokey',
+                       help='REPOKEY in the blackhole.'
+                       ' Use the REPOKEY of current repository if empty.')
+        if command == 'export':
+            p.add_argument('--since', metavar='BUNDLE',
+                           help='omit objects in this (previous) bundle')
+        p.add_argument('file', metavar='FILE', help='bundle file')
+
+    p = subp('ls-repos', cli_ls_repos)
+    p.add_argument('--remote', default='blackhole',
+                   help='name of the remote blackhole repository')
+    p.add_argument('--refresh', action='store_true',
+                   help='always fetch the listing of the remote refs')
+    p.add_argument('--max-age', type=float, default=3600, metavar='SECONDS',
+                   help='fetch the listing of the remote refs if the'
+                   ' cached one is older than this')
+    p.add_argument('host', default='', metavar='HOST', nargs='?',
+                   help='show repositories only at this host')
+
     p = subp('push', cli_push)
     push_common(p)
     p.add_argument('--remote', default='blackhole',
@@ -747,11 +3641,98 @@ def make_parser(doc=__doc__):
     p.add_argument('--ref-glob', action='append', default=[],
                    dest='ref_globs',
                    help='add glob patterns to be pushed, e.g., wip/*')
+    p.add_argument('--stash-key', choices=['index', 'sha1'], default='index',
+                   help='name remote stashes by their position in the'
+                   ' stash list (index) or by their commit hash (sha1).'
+                   ' With sha1, remote stashes dropped locally are removed.')
+    p.add_argument('--prune', action='store_true',
+                   help='remove remote branches of this repository which'
+                   ' do not exist locally')
+    p.add_argument('--max-prune', type=int, default=20, metavar='N',
+                   help='do not prune anything if more than N branches'
+                   ' would be removed by --prune')
+    p.add_argument('--max-push-size', metavar='SIZE',
+                   help='refs sending more than SIZE bytes (suffix k, m'
+                   ' and g can be used) are handled as --oversized.'
+                   ' Default to blackhole.<REMOTE>.maxPushSize config.')
+    p.add_argument('--oversized', choices=['defer', 'skip'], default='defer',
+                   help='record refs larger than --max-push-size for'
+                   ' --deferred (defer) or just do not push them (skip)')
+    p.add_argument('--deferred', action='store_true',
+                   help='push only the refs deferred by --max-push-size'
+                   ' in the previous push, without the size limit')
+    p.add_argument('--bwlimit', metavar='RATE',
+                   help='limit upload bandwidth to RATE bytes per second'
+                   ' (suffix k, m and g can be used).  Only for SSH.'
+                   ' Default to blackhole.<REMOTE>.bwlimit config.')
+    p.add_argument('--time-budget', type=float, metavar='SECONDS',
+                   help='push HEAD and the current branch first and'
+                   ' defer the other refs not pushed within SECONDS')
+    p.add_argument('--background', action='store_true',
+                   help='push in a detached low-priority process')
+    p.add_argument('--log', dest='logfile', metavar='FILE',
+                   help='log file for --background.'
+                   ' Default to $GIT_DIR/blackhole/push.log')
     p.add_argument('--ignore-error', action='store_true',
                    help='quick with code 0 on error')
     p.add_argument('--skip-if-no-blackhole', action='store_true',
                    help='do nothing if git blackhole is not configured')
 
+    p = subp('status', cli_status)
+    p.add_argument('--remote', default='blackhole',  # FIXME: see above
+                   help='name of the remote blackhole repository')
+    p.add_argument('--ref-glob', action='append', default=[],
+                   dest='ref_globs',
+                   help='add glob patterns to be pushed, e.g., wip/*')
+    p.add_argument('--stash-key', choices=['index', 'sha1'], default='index',
+                   help='see git blackhole push')
+    p.add_argument('--quiet', '-q', action='store_true',
+                   help='print nothing; only set the exit code')
+
+    p = subp('maintain', cli_maintain)
+    p.add_argument('--remote', default='blackhole',  # FIXME: see above
+                   help='name of the remote blackhole repository'
+                   ' used when PATH is not given')
+    p.add_argument('path', metavar='PATH', nargs='?',
+                   help='path to the blackhole repository')
+
+    p = subp('prefetch', cli_prefetch)
+    p.add_argument('--min-interval', type=float, default=0,
+                   metavar='SECONDS',
+                   help='skip remotes fetched within SECONDS')
+    p.add_argument('remotes', metavar='REMOTE', nargs='*',
+                   help='remotes to prefetch.  Default to the remotes'
+                   ' with config blackhole.$NAME.prefetch.')
+
+    p = subp('install-hook', cli_install_hook)
+    p.add_argument('--hook', action='append', dest='hooks',
+                   choices=['post-commit', 'post-merge', 'post-checkout',
+                            'post-rewrite'],
+                   help='hook to install.  Can be given multiple times.'
+                   ' Default to post-commit.')
+    p.add_argument('--remote', default='blackhole',  # FIXME: see above
+                   help='name of the remote blackhole repository')
+    p.add_argument('--uninstall', action='store_true',
+                   help='remove installed hooks and restore the original'
+                   ' ones')
+
+    p = subp('watch', cli_watch)
+    push_common(p)
+    p.add_argument('--remote', default='blackhole',  # FIXME: see above
+                   help='name of the remote blackhole repository')
+    p.add_argument('--ref-glob', action='append', default=[],
+                   dest='ref_globs',
+                   help='add glob patterns to be pushed, e.g., wip/*')
+    p.add_argument('--quiet-period', type=float, default=2,
+                   metavar='SECONDS',
+                   help='push after refs are not changed for this period')
+    p.add_argument('--interval', type=float, default=1, metavar='SECONDS',
+                   help='polling interval used when inotify is not'
+                   ' available')
+    p.add_argument('repos', metavar='repo', nargs='*',
+                   help='repositories to watch.'
+                   ' Watch current repository if not given.')
+
     p = subp('trash-branch', cli_trash_branch)
     push_common(p)
     p.add_argument('branches', metavar='branch', nargs='+',
@@ -764,6 +3745,22 @@ def make_parser(doc=__doc__):
                    ' at branch.<branch>.remote. ignored if no remote'
                    ' is set.')
 
+    p = subp('auto-trash', cli_auto_trash)
+    push_common(p)
+    p.add_argument('--merged-into', metavar='COMMIT',
+                   help='select branches merged into COMMIT')
+    p.add_argument('--older-than', type=float, metavar='DAYS',
+                   help='select branches whose last commit is older than'
+                   ' this')
+    p.add_argument('--pattern', action='append', default=[],
+                   dest='patterns',
+                   help='select branches matching this glob')
+    p.add_argument('--remote', default='blackhole',  # FIXME: see above
+                   help='name of the remote blackhole repository')
+    p.add_argument('--remove-upstream', '-u', action='store_true',
+                   help='remove branch in upstream repository.'
+                   ' See git blackhole trash-branch.')
+
     p = subp('trash-stash', cli_trash_stash)
     push_common(p)
     p.add_argument('--remote', default='blackhole',  # FIXME: see above
@@ -779,10 +3776,43 @@ def make_parser(doc=__doc__):
     p = subp('fetch-trash', cli_fetch_trash)
     p.add_argument('--remote', default='blackhole',  # FIXME: see above
                    help='name of the remote blackhole repository')
+    p.add_argument('--metadata-only', action='store_true',
+                   help='fetch commits only; trees and blobs are fetched'
+                   ' on demand')
+
+    p = subp('find-trash', cli_find_trash)
+    p.add_argument('commit', help='commit to be searched')
+
+    p = subp('compact', cli_compact)
+    p.add_argument('--remote', default='blackhole',  # FIXME: see above
+                   help='name of the remote blackhole repository')
+    p.add_argument('--host', default='',
+                   help='compact trashes made at this host.'
+                   ' Use current host name if empty.')
+    p.add_argument('--older-than', type=float, default=90, metavar='DAYS',
+                   help='compact only trashes older than this')
+    p.add_argument('--period', choices=['month', 'year'], default='month',
+                   help='make an archive for each of this period')
 
     p = subp('ls-trash', cli_ls_trash)
     p = subp('show-trash', cli_show_trash)
 
+    p = subp('restore-trash', cli_restore_trash)
+    p.add_argument('--all', '-a', action='store_true',
+                   help='restore all local copy of trashes')
+    p.add_argument('--branch', action='append', default=[],
+                   dest='branches',
+                   help='restore trashes of branches matching this glob')
+    p.add_argument('--host',
+                   help='restore trashes made at this host')
+    p.add_argument('--since', metavar='DATE',
+                   help='restore trashes made after DATE')
+    p.add_argument('--until', metavar='DATE',
+                   help='restore trashes made before DATE')
+    p.add_argument('--on-conflict', choices=['skip', 'rename', 'force'],
+                   default='skip',
+                   help='what to do when the branch already exists')
+
     p = subp('rm-local-trash', cli_rm_local_trash)
     p.add_argument('--all', '-a', action='store_true',
                    help='remove all local copy of trashes')
@@ -793,11 +3823,46 @@ def make_parser(doc=__doc__):
 
 
 def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    if args[:1] == ['--throttle-ssh']:
+        # Internal: used as GIT_SSH_COMMAND by `throttled_ssh_command`.
+        sys.exit(throttle_ssh(int(args[1]), *args[2:]))
     parser = make_parser()
     ns = parser.parse_args(args)
     debug = ns.__dict__.pop('debug')
     ignore_error = ns.__dict__.pop('ignore_error', False)
+    logfile = ns.__dict__.pop('logfile', None)
+    if ns.__dict__.pop('background', False):
+        # Remove --background (possibly abbreviated) from arguments:
+        spawn_background(
+            [a for a in args
+             if not (a.startswith('--b') and '--background'.startswith(a))],
+            logfile or getgitpath('blackhole/push.log'))
+        return
+    timeout = ns.__dict__.pop('timeout')
+    # Only the commands talking to remotes pay for reading the config
+    # and setting up SSH multiplexing:
+    remote_command = ns.func in (
+        cli_push, cli_watch, cli_trash_branch, cli_auto_trash,
+        cli_trash_stash, cli_fetch_trash, cli_compact, cli_export,
+        cli_import, cli_ls_repos, cli_prefetch)
+    stop_ssh_multiplexing = None
     try:
+        if timeout is None and remote_command:
+            timeout = getconfig('blackhole.timeout')
+        try:
+            timeout = float(timeout or 0) or None
+        except ValueError:
+            raise BlackholeError(
+                'Invalid blackhole.timeout: {0}'.format(timeout))
+        if ns.func is cli_watch:
+            # The deadline is set for each push:
+            ns.timeout = timeout
+        else:
+            set_deadline(timeout)
+        if remote_command:
+            stop_ssh_multiplexing = start_ssh_multiplexing()
         # FIXME: stop returning error code from cli_* functions
         code = (lambda func, **kwds: func(**kwds))(**vars(ns))
         if ignore_error:
@@ -816,6 +3881,9 @@ def main(args=None):
             print("ignoring the error")
             return
         sys.exit(err.returncode + 122)
+    finally:
+        if stop_ssh_multiplexing:
+            stop_ssh_multiplexing()
 
 
 if __name__ == '__main__':
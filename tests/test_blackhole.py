@@ -9,7 +9,12 @@ from .test_git_tools import commitchange
 from git_blackhole import make_run, trash_commitish, trashinfo, gettrashes, \
     git_json_commit, cli_init, cli_trash_branch, cli_trash_stash, \
     cli_fetch_trash, cli_ls_trash, cli_show_trash, cli_rm_local_trash, \
-    cli_warp, cli_push, make_parser, main, getprefix, getconfig
+    cli_warp, cli_push, cli_compact, cli_watch, make_parser, main, \
+    getprefix, getconfig, getremoterepos, ObjectReader, _gettrashes, \
+    cli_status, count_unpushed, cli_restore_trash, cli_find_trash, \
+    find_trashes, cli_maintain, cli_auto_trash, select_stale_branches, \
+    Blackhole, BlackholeError, NotConfigured, cli_export, cli_import, \
+    getrefnames, cli_install_hook, cli_prefetch
 
 
 run = make_run(True, False)
@@ -155,6 +160,323 @@ class TestPush(MixInBlackholePerMethod, unittest.TestCase):
         blackhole_rev_1 = git_revision(blackhole_head, cwd='../blackhole.git')
         assert local_rev_1 == blackhole_rev_1
 
+    def test_push_ref_glob(self):
+        for ref in ['refs/wip/master', 'refs/wip/nested/branch',
+                    'refs/remotes/wip/master', 'refs/other/master']:
+            run('git', 'update-ref', ref, 'HEAD')
+        self.cli_push(ref_globs=['refs/wip/*', '*/wip/*'])
+        out = check_output(['git', 'for-each-ref', '--format=%(refname)'],
+                           cwd='../blackhole.git', universal_newlines=True)
+        prefix = 'refs/' + getprefix('wip')
+        assert sorted(r for r in out.splitlines() if '/wip/' in r) == [
+            prefix + '/master', prefix + '/nested/branch']
+
+    def blackhole_refs(self, type):
+        out = check_output(['git', 'for-each-ref', '--format=%(refname)',
+                            'refs/heads/' + getprefix(type)],
+                           cwd='../blackhole.git', universal_newlines=True)
+        return out.splitlines()
+
+    def test_push_stash_sha1(self):
+        for i in range(2):
+            with open('README', 'a') as file:
+                file.write('stash {0}'.format(i))
+            run('git', 'stash')
+        self.cli_push()
+        assert len(self.blackhole_refs('stash')) == 2
+
+        self.cli_push(stash_key='sha1')
+        stashes = [git_revision('stash@{{{0}}}'.format(i)) for i in range(2)]
+        prefix = 'refs/heads/{0}/sha1/'.format(getprefix('stash'))
+        assert sorted(self.blackhole_refs('stash')) == \
+            sorted(prefix + s for s in stashes)
+
+        run('git', 'stash', 'drop', 'stash@{1}')
+        self.cli_push(stash_key='sha1')
+        assert self.blackhole_refs('stash') == [prefix + stashes[0]]
+
+    def test_push_prune(self):
+        for branch in ['gone1', 'gone2', 'kept']:
+            run('git', 'branch', branch)
+        self.cli_push()
+        run('git', 'branch', '-D', 'gone1', 'gone2')
+        prefix = 'refs/heads/{0}/'.format(getprefix('heads'))
+
+        self.cli_push(prune=True, max_prune=1)
+        assert prefix + 'gone1' in self.blackhole_refs('heads')
+
+        self.cli_push(prune=True)
+        assert sorted(self.blackhole_refs('heads')) == \
+            [prefix + b for b in ['HEAD', 'kept', 'master']]
+
+    def test_push_oversized(self):
+        run('git', 'checkout', '-b', 'big')
+        with open('big', 'wb') as file:
+            file.write(os.urandom(1 << 16))
+        run('git', 'add', 'big')
+        run('git', 'commit', '--message', 'Add big file')
+        run('git', 'checkout', 'master')
+        prefix = 'refs/heads/{0}/'.format(getprefix('heads'))
+
+        self.cli_push(max_push_size='32k', oversized='skip')
+        assert sorted(self.blackhole_refs('heads')) == \
+            [prefix + b for b in ['HEAD', 'master']]
+
+        self.cli_push(max_push_size='32k', oversized='defer')
+        assert sorted(self.blackhole_refs('heads')) == \
+            [prefix + b for b in ['HEAD', 'master']]
+        self.cli_push(deferred=True)
+        assert sorted(self.blackhole_refs('heads')) == \
+            [prefix + b for b in ['HEAD', 'big', 'master']]
+        # Nothing is deferred any more:
+        self.cli_push(deferred=True)
+        self.cli_push(max_push_size='32k')
+
+    def test_push_background(self):
+        import time
+        log = self.tmppath('push.log')
+        main(['push', '--background', '--log', log])
+        for _ in range(100):
+            with open(log) as file:
+                if 'exit status' in file.read():
+                    break
+            time.sleep(0.1)
+        with open(log) as file:
+            assert 'exit status: 0' in file.read()
+        assert git_revision() == \
+            git_revision(getprefix('heads') + '/HEAD', cwd='../blackhole.git')
+
+    def test_install_hook(self):
+        import sys
+        import time
+        import git_blackhole
+        hook = run('git', 'rev-parse', '--git-path', 'hooks/post-commit',
+                   out=True).decode().strip()
+        pending = run('git', 'rev-parse', '--git-path',
+                      'blackhole/push-pending', out=True).decode().strip()
+        with open(hook, 'w') as file:
+            file.write('#!/bin/sh\ntouch chained\n')
+        os.chmod(hook, 0o755)
+        cli_install_hook(hooks=None, remote='blackhole', uninstall=False,
+                         verbose=True, dry_run=False)
+        assert os.path.exists(hook + '.pre-blackhole')
+
+        # The hook runs git-blackhole found in $PATH:
+        bindir = self.tmppath('bin')
+        os.makedirs(bindir)
+        script = os.path.join(bindir, 'git-blackhole')
+        with open(script, 'w') as file:
+            file.write('#!/bin/sh\nexec {0} {1} "$@"\n'.format(
+                sys.executable, git_blackhole.__file__))
+        os.chmod(script, 0o755)
+        path = os.environ['PATH']
+        os.environ['PATH'] = bindir + os.pathsep + path
+        try:
+            commitchange()
+        finally:
+            os.environ['PATH'] = path
+        assert os.path.exists('chained')
+        blackhole_head = getprefix('heads') + '/HEAD'
+        for _ in range(100):
+            if not os.path.exists(pending) and \
+                    call(['git', 'rev-parse', '--verify', '--quiet',
+                          blackhole_head], cwd='../blackhole.git') == 0:
+                break
+            time.sleep(0.1)
+        assert git_revision() == git_revision(blackhole_head,
+                                              cwd='../blackhole.git')
+
+        # No push is started while another one is pending:
+        open(pending, 'w').close()
+        commitchange()
+        time.sleep(0.5)
+        assert os.path.exists(pending)
+        assert git_revision() != git_revision(blackhole_head,
+                                              cwd='../blackhole.git')
+
+        cli_install_hook(hooks=None, remote='blackhole', uninstall=True,
+                         verbose=True, dry_run=False)
+        with open(hook) as file:
+            assert file.read() == '#!/bin/sh\ntouch chained\n'
+
+    def test_watch(self):
+        import threading
+        import time
+        repo = os.getcwd()
+        thread = threading.Thread(target=cli_watch, kwargs=dict(
+            repos=[repo], quiet_period=0.2, interval=0.1, remote='blackhole',
+            ref_globs=[], verbose=True, dry_run=False, _rounds=2))
+        thread.daemon = True
+        thread.start()
+        prefix = 'refs/heads/{0}/'.format(getprefix('heads'))
+        for _ in range(100):
+            if prefix + 'HEAD' in self.blackhole_refs('heads'):
+                break
+            time.sleep(0.1)
+        for branch in ['new1', 'new2']:
+            check_call(['git', 'branch', branch], cwd=repo)
+        thread.join(10)
+        assert not thread.is_alive()
+        assert sorted(self.blackhole_refs('heads')) == \
+            [prefix + b for b in ['HEAD', 'master', 'new1', 'new2']]
+
+    def test_watch_timeout(self):
+        import functools
+        import threading
+        import time
+        from unittest import mock
+        import git_blackhole
+        run('git', 'config', 'blackhole.timeout', '1')
+        watch = functools.partial(git_blackhole.cli_watch, _rounds=2)
+        watch.__doc__ = git_blackhole.cli_watch.__doc__
+        prefix = 'refs/heads/{0}/'.format(getprefix('heads'))
+
+        def target():
+            with pytest.raises(SystemExit):
+                main(['watch', '--quiet-period', '0.2', '--interval', '0.1'])
+
+        with mock.patch('git_blackhole.cli_watch', watch):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+            for _ in range(100):
+                if prefix + 'HEAD' in self.blackhole_refs('heads'):
+                    break
+                time.sleep(0.1)
+            # The timeout applies to each push, not to the whole watch:
+            time.sleep(1.5)
+            check_call(['git', 'branch', 'new'])
+            thread.join(10)
+        assert not thread.is_alive()
+        assert sorted(self.blackhole_refs('heads')) == \
+            [prefix + b for b in ['HEAD', 'master', 'new']]
+
+    def test_push_time_budget(self):
+        run('git', 'branch', 'other')
+        self.cli_push(time_budget=0)
+        prefix = getprefix('heads')
+        refs = run('git', 'for-each-ref', '--format=%(refname)',
+                   cwd='../blackhole.git', out=True).decode().split()
+        assert sorted(refs) == ['refs/heads/{0}/{1}'.format(prefix, b)
+                                for b in ['HEAD', 'master']]
+        self.cli_push(time_budget=60)
+        assert git_revision('other') == git_revision(
+            prefix + '/other', cwd='../blackhole.git')
+
+    def test_push_invalid_timeout(self):
+        run('git', 'config', 'blackhole.timeout', '1min')
+        with pytest.raises(SystemExit) as excinfo:
+            main(['push'])
+        assert excinfo.value.code == 1
+
+    def test_push_metrics(self):
+        import json
+        promfile = self.tmppath('metrics', 'blackhole.prom')
+        run('git', 'config', 'blackhole.promFile', promfile)
+        self.cli_push()
+        commitchange()
+        self.cli_push()
+        with open(promfile + '.json') as file:
+            stats = json.load(file)
+        (metrics,) = stats.values()
+        assert metrics['push_total'] == 2
+        assert metrics['push_failures_total'] == 0
+        assert metrics['push_refs_updated_total'] == 4
+        assert metrics['push_bytes_total'] > 0
+        assert metrics['push_duration_seconds']['count'] == 2
+        with open(promfile) as file:
+            assert 'git_blackhole_push_total{repo=' in file.read()
+
+    def test_push_metrics_timeout(self):
+        import json
+        from unittest import mock
+        from git_blackhole import BlackholeTimeout
+        promfile = self.tmppath('metrics', 'blackhole.prom')
+        run('git', 'config', 'blackhole.promFile', promfile)
+        with mock.patch('git_blackhole.plan_push',
+                        side_effect=BlackholeTimeout('timed out')), \
+                pytest.raises(BlackholeTimeout):
+            self.cli_push()
+        with open(promfile + '.json') as file:
+            stats = json.load(file)
+        (metrics,) = stats.values()
+        assert metrics['push_total'] == 1
+        assert metrics['push_failures_total'] == 1
+        assert metrics['push_duration_seconds']['count'] == 1
+
+    def test_push_metrics_oversized(self):
+        import json
+        run('git', 'checkout', '-b', 'big')
+        with open('big', 'wb') as file:
+            file.write(os.urandom(1 << 16))
+        run('git', 'add', 'big')
+        run('git', 'commit', '--message', 'Add big file')
+        run('git', 'checkout', 'master')
+        promfile = self.tmppath('metrics', 'blackhole.prom')
+        run('git', 'config', 'blackhole.promFile', promfile)
+        self.cli_push(max_push_size='32k')
+        with open(promfile + '.json') as file:
+            stats = json.load(file)
+        (metrics,) = stats.values()
+        # The deferred branch is not counted:
+        assert 0 < metrics['push_bytes_total'] < 1 << 15
+
+    def test_maintain(self):
+        self.cli_push()
+        cli_maintain(path=None, remote='blackhole', verbose=True,
+                     dry_run=False)
+        blackhole = os.path.join('..', 'blackhole.git')
+        assert os.path.exists(os.path.join(blackhole, 'packed-refs'))
+        assert os.path.exists(os.path.join(blackhole, 'objects', 'pack',
+                                           'multi-pack-index'))
+        assert git_revision('HEAD') == git_revision(
+            getprefix('heads') + '/HEAD', cwd=blackhole)
+
+    def test_status(self):
+        def status():
+            return cli_status(remote='blackhole', ref_globs=[],
+                              stash_key='index', quiet=False,
+                              verbose=False, dry_run=False)
+
+        assert status() == 1
+        self.cli_push()
+        assert status() is None
+        commitchange()
+        commitchange()
+        assert count_unpushed([git_revision()], 'blackhole') == [2]
+        assert status() == 1
+        self.cli_push()
+        assert status() is None
+
+
+FAKE_SSH = """\
+#!{python}
+# Fake ssh emulating connection sharing by ControlPath.
+import os
+import subprocess
+import sys
+
+args = sys.argv[1:]
+control = ctl = None
+while args[0].startswith('-'):
+    opt = args.pop(0)
+    if opt == '-o' and args[0].startswith('ControlPath='):
+        control = args.pop(0)[len('ControlPath='):]
+    elif opt == '-O':
+        ctl = args.pop(0)
+    elif opt in ('-o', '-p'):
+        args.pop(0)
+if ctl == 'exit':
+    os.remove(control)
+    sys.exit()
+if not (control and os.path.exists(control)):
+    with open({log!r}, 'a') as file:
+        file.write('handshake\\n')
+    if control:
+        open(control, 'w').close()
+sys.exit(subprocess.call(['sh', '-c', ' '.join(args[1:])]))
+"""
+
 
 class TestTrash(MixInBlackholePerMethod, unittest.TestCase):
 
@@ -177,6 +499,36 @@ class TestTrash(MixInBlackholePerMethod, unittest.TestCase):
             remote='blackhole', verbose=True, dry_run=False)
         assert call(['git', 'show-ref', '--verify', '--quiet', branch]) != 0
 
+    def test_trash_branches(self):
+        branches = ['garbage1', 'garbage2', 'garbage3']
+        for branch in branches:
+            run('git', 'branch', branch)
+        code = cli_trash_branch(
+            branches=branches + ['master'], remove_upstream=False,
+            remote='blackhole', verbose=True, dry_run=False)
+        assert code == 1
+        assert run('git', 'branch', '--list', 'garbage*', out=True) == b''
+        cli_fetch_trash(remote='blackhole', verbose=True, dry_run=False)
+        assert sorted(t['branch'] for t in gettrashes()) == branches
+
+    def test_auto_trash(self):
+        for branch in ['merged1', 'feature/merged2', 'unmerged']:
+            run('git', 'branch', branch)
+        run('git', 'checkout', 'unmerged')
+        commitchange()
+        run('git', 'checkout', 'master')
+        assert select_stale_branches(merged_into='master') == \
+            ['feature/merged2', 'merged1']
+        assert select_stale_branches(older_than=0, patterns=['*merged*']) \
+            == ['feature/merged2', 'merged1', 'unmerged']
+        assert select_stale_branches(older_than=1) == []
+        cli_auto_trash(merged_into='master', older_than=None,
+                       patterns=['feature/*'], remote='blackhole',
+                       remove_upstream=False, verbose=True, dry_run=False)
+        assert run('git', 'branch', '--format=%(refname:short)',
+                   out=True).decode().split() == \
+            ['master', 'merged1', 'unmerged']
+
     def test_trash_stash(self):
         assert run('git', 'stash', 'list', out=True).decode().strip() == ''
 
@@ -190,6 +542,77 @@ class TestTrash(MixInBlackholePerMethod, unittest.TestCase):
             remote='blackhole', verbose=True, dry_run=False)
         assert run('git', 'stash', 'list', out=True).decode().strip() == ''
 
+    def test_trash_dedupe(self):
+        def remote_trashes():
+            return run('git', 'for-each-ref', 'refs/heads/trash/',
+                       cwd='../blackhole.git', out=True).splitlines()
+
+        for _ in range(2):
+            self.test_trash_branch('garbage')
+        assert len(remote_trashes()) == 1
+        self.test_trash_branch('garbage2')
+        assert len(remote_trashes()) == 2
+
+        os.remove(run('git', 'rev-parse', '--git-path',
+                      'blackhole/trashed.json', out=True).decode().strip())
+        cli_fetch_trash(remote='blackhole', verbose=True, dry_run=False)
+        self.test_trash_branch('garbage')
+        assert len(remote_trashes()) == 2
+
+        # Trashes missing in the remote are not skipped:
+        for ref in remote_trashes():
+            run('git', 'update-ref', '-d', ref.split()[-1].decode(),
+                cwd='../blackhole.git')
+        self.test_trash_branch('garbage')
+        assert len(remote_trashes()) == 1
+
+        # The record is per URL:
+        run('git', 'init', '--bare', '../bh2.git')
+        run('git', 'remote', 'set-url', 'blackhole', '../bh2.git')
+        self.test_trash_branch('garbage')
+        assert len(run('git', 'for-each-ref', 'refs/heads/trash/',
+                       cwd='../bh2.git', out=True).splitlines()) == 1
+
+    def test_export_import(self):
+        def refs(repo):
+            return run('git', 'for-each-ref', '--format=%(refname)',
+                       cwd=repo, out=True).decode().split()
+
+        self.test_trash_branch()
+        TestPush.cli_push()
+        # Refs of a repository nested under this one are not exported:
+        run('git', 'push', 'blackhole', *[
+            'HEAD:refs/heads/{0}/sub/{1}'.format(getprefix(type), name)
+            for (type, name) in [('heads', 'HEAD'), ('stash', '0'),
+                                 ('trash', 'ab/' + 'c' * 38)]])
+        bundle1 = self.tmppath('1.bundle')
+        bundle2 = self.tmppath('2.bundle')
+        cli_export(bundle1, remote='blackhole', host='', repokey=None,
+                   since=None, verbose=True, dry_run=False)
+        assert cli_export(bundle2, remote='blackhole', host='', repokey=None,
+                          since=bundle1, verbose=True, dry_run=False) == 1
+
+        other = self.tmppath('other.git')
+        run('git', 'init', '--bare', other)
+        run('git', 'remote', 'add', 'other', other)
+        cli_import(bundle1, remote='other', host='newhost', repokey='key',
+                   verbose=True, dry_run=False)
+        assert sorted(r.split('/', 3)[2:3] for r in refs(other)) == \
+            [['heads'], ['heads'], ['trash']]
+        assert all(r.split('/')[3:5] == ['newhost', 'key']
+                   for r in refs(other))
+
+        commitchange()
+        TestPush.cli_push()
+        cli_export(bundle2, remote='blackhole', host='', repokey=None,
+                   since=bundle1, verbose=True, dry_run=False)
+        assert run('git', 'bundle', 'list-heads', bundle2, out=True)
+        cli_import(bundle2, remote='other', host='newhost', repokey='key',
+                   verbose=True, dry_run=False)
+        assert git_revision() == git_revision(
+            'heads/newhost/key/master', cwd=other)
+        assert not getrefnames(['refs/bh/import/'])
+
     def test_fetch_trash(self):
         self.test_trash_branch()
         self.test_trash_stash()
@@ -201,6 +624,172 @@ class TestTrash(MixInBlackholePerMethod, unittest.TestCase):
         assert set(t['command'] for t in trashes2) == \
             {'trash-branch', 'trash-stash'}
 
+    def test_fetch_trash_metadata_only(self):
+        run('git', 'checkout', '-b', 'garbage')
+        commitchange(change='only in trash')
+        run('git', 'checkout', 'master')
+        cli_trash_branch(
+            branches=['garbage'], remove_upstream=False,
+            remote='blackhole', verbose=True, dry_run=False)
+        run('git', 'config', 'uploadpack.allowFilter', 'true',
+            cwd='../blackhole.git')
+        # Remove the trashed objects from the local repository:
+        run('git', 'reflog', 'expire', '--expire=now', '--all')
+        run('git', 'gc', '--prune=now', '--quiet')
+        cli_fetch_trash(remote='blackhole', verbose=True, dry_run=False,
+                        metadata_only=True)
+        (trash,) = gettrashes()
+        assert trash['branch'] == 'garbage'
+        missing = run('git', 'rev-list', '--objects', '--missing=print',
+                      trash['rev'], out=True).split()
+        assert [o for o in missing if o.startswith(b'?')]
+        # Trees and blobs are fetched on demand:
+        assert b'only in trash' in run('git', 'show', trash['rev'], out=True)
+
+    def test_compact(self):
+        for branch in ['garbage1', 'garbage2', 'garbage3']:
+            self.test_trash_branch(branch)
+        self.test_trash_stash()
+        cli_compact(remote='blackhole', host='', older_than=0,
+                    period='year', verbose=True, dry_run=False)
+        out = check_output(['git', 'for-each-ref', '--format=%(refname)',
+                            'refs/heads/' + getprefix('trash')],
+                           cwd='../blackhole.git', universal_newlines=True)
+        assert len(out.splitlines()) == 1
+        assert len(gettrashes()) == 4
+
+        cli_rm_local_trash(verbose=True, dry_run=False, refs=[], all=True)
+        cli_fetch_trash(remote='blackhole', verbose=True, dry_run=False)
+        trashes = gettrashes()
+        assert sorted(t.get('branch') or '' for t in trashes) == \
+            ['', 'garbage1', 'garbage2', 'garbage3']
+
+    def test_gettrashes_reader(self):
+        self.test_compact()
+        for gc in [False, True]:
+            if gc:
+                check_call(['git', 'gc', '--quiet'])
+            reader = ObjectReader()
+            assert _gettrashes(reader) == _gettrashes(None)
+            reader.close()
+
+    def test_find_trash(self):
+        run('git', 'checkout', '-b', 'garbage1')
+        commitchange()
+        commit = git_revision()
+        run('git', 'checkout', '-b', 'garbage2')
+        commitchange()
+        run('git', 'checkout', 'master')
+        self.test_trash_branch('garbage3')
+        cli_trash_branch(
+            branches=['garbage1', 'garbage2'], remove_upstream=False,
+            remote='blackhole', verbose=True, dry_run=False)
+        cli_fetch_trash(remote='blackhole', verbose=True, dry_run=False)
+        graphs = os.path.join(run('git', 'rev-parse', '--git-common-dir',
+                                  out=True).decode().strip(),
+                              'objects', 'info', 'commit-graphs')
+        assert os.listdir(graphs)
+        assert sorted(t['branch'] for t in find_trashes(commit)) == \
+            ['garbage1', 'garbage2']
+
+        cli_compact(remote='blackhole', host='', older_than=0,
+                    period='year', verbose=True, dry_run=False)
+        from unittest import mock
+        with mock.patch('git_blackhole.trashinfo',
+                        wraps=trashinfo) as info:
+            assert sorted(t['branch'] for t in find_trashes(commit)) == \
+                ['garbage1', 'garbage2']
+        # Only the archive and the trashes containing `commit` are read:
+        assert info.call_count == 3
+        assert cli_find_trash('HEAD', verbose=False, dry_run=False) is None
+        commitchange(change='not trashed')
+        assert cli_find_trash('HEAD', verbose=False, dry_run=False) == 1
+
+    def test_restore_trash(self):
+        def restore(**kwds):
+            default_kwds = dict(all=False, branches=[], host=None,
+                                since=None, until=None, on_conflict='skip',
+                                verbose=True, dry_run=False)
+            cli_restore_trash(**dict(default_kwds, **kwds))
+
+        def branches():
+            return run('git', 'branch', '--list', 'garbage*',
+                       '--format=%(refname:short)', out=True).decode().split()
+
+        self.test_trash_branches()
+        self.test_trash_stash()
+        cli_fetch_trash(remote='blackhole', verbose=True, dry_run=False)
+        restore(branches=['garbage[12]'])
+        assert branches() == ['garbage1', 'garbage2']
+        commitchange()
+        run('git', 'branch', '--force', 'garbage1', 'HEAD')
+        restore(all=True, on_conflict='rename')
+        assert len(branches()) == 4
+        restore(all=True, on_conflict='rename')
+        assert len(branches()) == 4
+        before = branches()
+        [renamed] = [b for b in before if '-trash-' in b]
+        run('git', 'branch', '--force', renamed, 'HEAD')
+        restore(all=True, on_conflict='rename')
+        assert branches() == sorted(before + [renamed + '-2'])
+        assert run('git', 'stash', 'list', out=True).decode().strip()
+        restore(all=True, on_conflict='force')
+        assert git_revision('garbage1') == git_revision('garbage2')
+
+    def test_ssh_multiplexing(self):
+        import sys
+        import time
+        log = self.tmppath('ssh.log')
+        fakessh = self.tmppath('bin', 'ssh')
+        os.makedirs(os.path.dirname(fakessh))
+        with open(fakessh, 'w') as file:
+            file.write(FAKE_SSH.format(python=sys.executable, log=log))
+        os.chmod(fakessh, 0o755)
+        run('git', 'config', 'remote.blackhole.url',
+            'fakehost:' + os.path.abspath(os.path.join('..', 'blackhole.git')))
+
+        def handshakes(*args):
+            open(log, 'w').close()
+            with pytest.raises(SystemExit):
+                main(list(args))
+            with open(log) as file:
+                return len(file.readlines())
+
+        path = os.environ['PATH']
+        os.environ['PATH'] = os.path.dirname(fakessh) + os.pathsep + path
+        try:
+            self.test_trash_branches()
+            # "ls-remote" and "fetch" share one connection:
+            assert handshakes('fetch-trash') == 1
+
+            # Background prefetch started by push does not use the
+            # connections closed when push exits:
+            run('git', 'remote', 'add', 'bh_self',
+                'fakehost:' + os.path.abspath('../blackhole.git'))
+            run('git', 'config', 'blackhole.bh_self.prefetch', 'true')
+            with pytest.raises(SystemExit):
+                main(['push'])
+            for _ in range(100):
+                if getrefnames(['refs/prefetch/']):
+                    break
+                time.sleep(0.1)
+            assert getrefnames(['refs/prefetch/'])
+
+            run('git', 'config', 'blackhole.sshMultiplex', 'false')
+            assert handshakes('fetch-trash') == 2
+        finally:
+            os.environ['PATH'] = path
+        assert 'GIT_SSH_COMMAND' not in os.environ
+
+        # Not set up for commands not talking to remotes:
+        from unittest import mock
+        with mock.patch('git_blackhole.start_ssh_multiplexing') as start, \
+                mock.patch('git_blackhole.getconfig') as getconfig:
+            with pytest.raises(SystemExit):
+                main(['ls-trash'])
+        assert not start.called
+        assert not getconfig.called
+
     def test_ls_trash_non_verbose(self):
         self.test_fetch_trash()
         cli_ls_trash(verbose=False, dry_run=False)
@@ -220,6 +809,42 @@ class TestTrash(MixInBlackholePerMethod, unittest.TestCase):
         assert len(trashes0) == 0
 
 
+class TestSession(MixInBlackholePerMethod, unittest.TestCase):
+
+    def test_session(self):
+        import contextlib
+        import io
+        repo = os.getcwd()
+        os.chdir('..')
+        out = io.StringIO()
+        with Blackhole(repo) as bh, contextlib.redirect_stdout(out):
+            assert [r['ref'] for r in bh.status()] == ['master', 'HEAD']
+            assert bh.push() == []
+            check_call(['git', 'branch', 'garbage'], cwd=repo)
+            (trashed,) = bh.trash_branches(['garbage'])
+            assert trashed['branch'] == 'garbage' and trashed['pushed']
+            with pytest.raises(BlackholeError):
+                bh.trash_branches(['master'])
+            with pytest.raises(BlackholeError):
+                bh.find_trashes('no-such-commit')
+            (trash,) = bh.fetch_trashes()
+            assert trash['branch'] == 'garbage'
+            assert trash['rev_info'] == trashed['rev_info']
+            assert bh.trashes() == [trash]
+            assert bh.find_trashes('master') == [trash]
+            assert [(t['ref'], t['restored'])
+                    for t in bh.restore_trashes(all=True)] == \
+                [('refs/heads/garbage', True)]
+            assert [(t['ref'], t['restored'])
+                    for t in bh.restore_trashes(all=True)] == \
+                [('refs/heads/garbage', False)]
+        assert out.getvalue() == ''
+        assert os.getcwd() != repo
+        run('git', 'rev-parse', '--verify', 'garbage', cwd=repo)
+        with pytest.raises(NotConfigured):
+            Blackhole(repo, remote='no-such-remote').push()
+
+
 class TestWarp(MixInBlackholePerMethod, unittest.TestCase):
 
     other_repos = ['another', 'blackhole.git']
@@ -245,6 +870,74 @@ class TestWarp(MixInBlackholePerMethod, unittest.TestCase):
         check_call(['git', 'show-ref', '--verify', '--quiet',
                     'refs/remotes/bh_another/master'])
 
+    def test_warp_lazy(self):
+        cwd = os.getcwd()
+        try:
+            os.chdir(self.tmppath('another'))
+            commitchange(change='only in another')
+            check_call(['git', 'push', 'blackhole', 'master', 'master:other'])
+        finally:
+            os.chdir(cwd)
+        check_call(['git', 'config', 'uploadpack.allowFilter', 'true'],
+                   cwd='../blackhole.git')
+        cli_warp(host='', repokey='another', name='bh_another',
+                 remote='blackhole', url='', branches=['master'],
+                 filter='blob:none', verbose=True, dry_run=False)
+        check_call(['git', 'fetch', 'bh_another'])
+        assert getrefnames(['refs/remotes/bh_another/']) == \
+            ['refs/remotes/bh_another/master']
+        missing = run('git', 'rev-list', '--objects', '--missing=print',
+                      'refs/remotes/bh_another/master', out=True).split()
+        assert [o for o in missing if o.startswith(b'?')]
+        # Blobs are fetched on demand:
+        assert run('git', 'show', 'refs/remotes/bh_another/master:README',
+                   out=True)
+
+    def test_prefetch(self):
+        import time
+        cli_warp(host='', repokey='another', name='bh_another',
+                 remote='blackhole', url='', prefetch=True,
+                 verbose=True, dry_run=False)
+        assert cli_prefetch(remotes=[], min_interval=0,
+                            verbose=True, dry_run=False) == 0
+        prefetched = 'refs/prefetch/remotes/bh_another/master'
+        assert getrefnames(['refs/prefetch/']) == [prefetched]
+        assert getrefnames(['refs/remotes/bh_another/']) == []
+
+        # Remotes fetched recently are skipped:
+        run('git', 'update-ref', '-d', prefetched)
+        cli_prefetch(remotes=[], min_interval=3600,
+                     verbose=True, dry_run=False)
+        assert getrefnames(['refs/prefetch/']) == []
+
+        # Push starts the prefetch in background:
+        run('git', 'config', 'blackhole.prefetchInterval', '1')
+        time.sleep(1)
+        cli_push(verbose=True, dry_run=False, ref_globs=[],
+                 remote='blackhole', skip_if_no_blackhole=False)
+        for _ in range(100):
+            if getrefnames(['refs/prefetch/']):
+                break
+            time.sleep(0.1)
+        assert getrefnames(['refs/prefetch/']) == [prefetched]
+
+    def test_getremoterepos(self):
+        cli_push(verbose=True, dry_run=False, ref_globs=[],
+                 remote='blackhole', skip_if_no_blackhole=False)
+        host, repokey = getprefix('heads').split('/', 2)[1:]
+        repos = getremoterepos(run, 'blackhole')
+        assert [(r['host'], r['repokey'], r['branches']) for r in repos] == \
+            sorted([(host, 'another', 1), (host, repokey, 1)])
+
+        # The cached listing is used unless --refresh is given:
+        run('git', 'branch', 'new')
+        cli_push(verbose=True, dry_run=False, ref_globs=[],
+                 remote='blackhole', skip_if_no_blackhole=False)
+        assert getremoterepos(run, 'blackhole') == repos
+        repos = getremoterepos(run, 'blackhole', refresh=True)
+        assert [r['branches'] for r in repos if r['repokey'] == repokey] \
+            == [2]
+
 
 class TestMisc(MixInGitReposPerClass, unittest.TestCase):
 
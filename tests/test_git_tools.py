@@ -3,7 +3,9 @@ from subprocess import check_call, check_output
 
 from .testutils import MixInGitRepoPerClass, MixInGitRepoPerMethod
 from git_blackhole import getconfig, getbranches, \
-    git_stash_list, parse_stash, git_annot_commit
+    git_stash_list, parse_stash, git_annot_commit, git_annot_commits, \
+    make_ref_poller, make_ref_inotify, ObjectReader, set_deadline, \
+    BlackholeTimeout, check_output as bh_check_output
 
 
 def commitchange(file='README', change='change',
@@ -41,6 +43,22 @@ class TestGitTools(MixInGitRepoPerMethod, unittest.TestCase):
         out = check_output(['git', 'show', rev])
         assert b'Annotate newbranch' in out
 
+    def test_annot_commits(self):
+        import os
+        commitchange()
+        check_call(['git', 'branch', 'newbranch'])
+        commitchange()
+        os.environ['GIT_AUTHOR_DATE'] = os.environ['GIT_COMMITTER_DATE'] = \
+            '1500000000 +0000'
+        try:
+            annotations = [('Annotate master', 'master'),
+                           ('Annotate newbranch', 'newbranch')]
+            assert git_annot_commits(annotations) == \
+                [git_annot_commit(*a) for a in annotations]
+        finally:
+            del os.environ['GIT_AUTHOR_DATE']
+            del os.environ['GIT_COMMITTER_DATE']
+
     def test_getbranches(self):
         commitchange()
         assert getbranches() == (["master"], ["master"])
@@ -66,3 +84,79 @@ class TestGitTools(MixInGitRepoPerMethod, unittest.TestCase):
         assert [s[0] for s in stashes] == list(range(num))
         assert [s[1] for s in stashes] == \
             list(map('refs/stash@{{{0}}}'.format, range(num)))
+
+    def test_ref_watchers(self):
+        import os
+        commitchange()
+        gitdir = os.path.abspath('.git')
+        repos = {'repo': (gitdir, gitdir)}
+        for make in [make_ref_poller, make_ref_inotify]:
+            wait = make(repos)
+            assert wait(0) == set()
+            check_call(['git', 'branch', make.__name__])
+            assert wait(5) == {'repo'}
+            check_call(['git', 'update-ref', 'refs/remotes/origin/x', 'HEAD'])
+            assert wait(0.5) == set()
+
+
+class TestObjectReader(MixInGitRepoPerMethod, unittest.TestCase):
+
+    def test_read(self):
+        for i in range(20):
+            commitchange(change='change {0}\n'.format(i) * 50)
+        objects = check_output(['git', 'rev-list', '--objects',
+                                '--no-object-names', 'HEAD'],
+                               universal_newlines=True).split()
+        assert len(objects) == 20 * 3
+        for gc in [False, True]:
+            if gc:
+                check_call(['git', 'repack', '-adf', '--quiet'])
+            reader = ObjectReader()
+            for sha1 in objects:
+                type = check_output(['git', 'cat-file', '-t', sha1])
+                data = check_output(['git', 'cat-file', type.strip(), sha1])
+                assert reader.read(sha1) == (type.decode().strip(), data)
+            assert reader.refs('refs/heads/') == [
+                ('refs/heads/master',
+                 check_output(['git', 'rev-parse', 'HEAD']).decode().strip())]
+            reader.close()
+
+
+class TestDeadline(unittest.TestCase):
+
+    def tearDown(self):
+        set_deadline(None)
+
+    def test_timeout(self):
+        import time
+        set_deadline(0.5)
+        start = time.time()
+        with self.assertRaises(BlackholeTimeout):
+            bh_check_output(['sh', '-c', 'sleep 10 & wait'])
+        assert time.time() - start < 5
+
+    def test_interrupt(self):
+        import os
+        import signal
+        import tempfile
+        import time
+
+        def interrupt(signum, frame):
+            raise KeyboardInterrupt
+
+        set_deadline(60)
+        with tempfile.NamedTemporaryFile() as pidfile:
+            handler = signal.signal(signal.SIGALRM, interrupt)
+            signal.alarm(1)
+            try:
+                with self.assertRaises(KeyboardInterrupt):
+                    bh_check_output(['sh', '-c', 'sleep 60 & echo $! > {0};'
+                                     ' wait'.format(pidfile.name)])
+            finally:
+                signal.alarm(0)
+                signal.signal(signal.SIGALRM, handler)
+            pid = int(pidfile.read())
+        with self.assertRaises(OSError):
+            for _ in range(50):
+                os.kill(pid, 0)
+                time.sleep(0.1)